@@ -1,42 +1,91 @@
 """aq - Query AWS resources with SQL
 
 Usage:
-    aq [--profile=<profile>] [--region=<region>] [--table-cache-ttl=<seconds>] [-v] [--debug]
-    aq [--profile=<profile>] [--region=<region>] [--table-cache-ttl=<seconds>] [-v] [--debug] <query>
+    aq [options]
+    aq [options] <query>
+    aq [options] --file=<file> [--output-dir=<dir>]
 
 Sample queries:
     aq "select tags->'Name' from ec2_instances"
     aq "select count(*) from us_west_1.ec2_instances"
+    aq --file=report.sql --output-dir=report
 
 Options:
     --profile=<profile>  Use a specific profile from your credential file
     --region=<region>  The region to use. Overrides config/env settings
     --table-cache-ttl=<seconds>  number of seconds to cache the tables
                                  before we update them from AWS again [default: 300]
+    --table-ttls=<ttls>  cache ttl of specific tables, overriding --table-cache-ttl, as comma separated
+                         <table pattern>=<seconds>, e.g. "ec2_instances=60,iam_*=86400"
+    --adaptive-ttl  lengthen the cache ttl of the tables that don't change between refreshes and
+                    shorten it for the ones that change a lot
+    --storage=<storage>  how cached tables are stored: "region" for one database file
+                         per region, "table" for one database file per table or "memory" to keep
+                         them in memory only, for short-lived runs [default: region]
+    --intern-json  store repeated JSON values (e.g. the same placement or security groups of
+                   many instances) only once per table
+    --snapshots  keep every refresh of a table as a snapshot, queryable via the
+                 <table>_history view (e.g. ec2_instances_history)
+    --prefetch=<tables>  max number of tables predicted to be queried next to load in
+                         the background in the REPL, 0 to disable [default: 3]
+    --file=<file>  execute all the ";" separated queries in given file, loading all of
+                   their tables at once
+    --output-dir=<dir>  write the result of each query of --file to its own file in given dir
+                        instead of the standard output
+    --explain  show which tables a query would fetch from AWS and how long that should take,
+               instead of executing it (or each query of --file)
+    --max-fetch-seconds=<seconds>  max time a query should wait for its tables to be fetched,
+                                   estimated from their last fetch. Stale cached tables are used
+                                   instead of tables that would take longer, queries needing such
+                                   tables but with no cache are refused
+    --query-timeout=<seconds>  interrupt queries running (not counting the tables loading
+                               nor the time their result is being paged) for longer than given time
+    --sample=<rows>  query only the first rows of each table, for fast approximate results.
+                     Samples are cached apart from whole tables, in ~/.aq/sample
     -v, --verbose  enable verbose logging
     --debug  enable debug mode
 """
 from __future__ import print_function
 
+import itertools
+import os
 import traceback
 from collections import namedtuple
 
 from docopt import docopt
 
-from aq.engines import BotoSqliteEngine
-from aq.errors import QueryError
+from aq import util
+from aq.engines import BotoSqliteEngine, InMemoryBotoSqliteEngine, PerTableBotoSqliteEngine
+from aq.errors import AQError, QueryError
 from aq.formatters import TableFormatter
-from aq.logger import initialize_logger
-from aq.parsers import SelectParser
+from aq.logger import get_logger, initialize_logger
+from aq.parsers import SelectParser, split_statements
 from aq.prompt import AqPrompt
 
 __version__ = '0.1.1'
 
+LOGGER = get_logger()
+
 QueryResult = namedtuple('QueryResult', ('parsed_query', 'query_metadata', 'columns', 'rows'))
 
+# results with at least that many rows are shown through a pager in the REPL, their first rows are also used
+# to size the columns
+PAGED_RESULT_MIN_ROWS = 1000
+
+
+ENGINES_BY_STORAGE = {
+    'region': BotoSqliteEngine,
+    'table': PerTableBotoSqliteEngine,
+    'memory': InMemoryBotoSqliteEngine,
+}
+
 
 def get_engine(options):
-    return BotoSqliteEngine(options)
+    storage = options.get('--storage') or 'region'
+    if storage not in ENGINES_BY_STORAGE:
+        raise AQError('Unknown storage "{0}", must be one of: {1}'.format(
+            storage, ', '.join(sorted(ENGINES_BY_STORAGE))))
+    return ENGINES_BY_STORAGE[storage](options)
 
 
 def get_parser(options):
@@ -58,29 +107,126 @@ def main():
     parser = get_parser(args)
     engine = get_engine(args)
     formatter = get_formatter(args)
+    run_query = explain_query if args['--explain'] else execute_query
 
-    if args['<query>']:
+    if args['--file']:
+        execute_batch(engine, formatter, parser, args['--file'], args['--output-dir'], explain=args['--explain'])
+    elif args['<query>']:
         query = args['<query>']
-        res = execute_query(engine, formatter, parser, query)
+        res = run_query(engine, formatter, parser, query)
         print(formatter.format(res.columns, res.rows))
     else:
         repl = get_prompt(parser, engine, args)
         while True:
             try:
                 query = repl.prompt()
-                res = execute_query(engine, formatter, parser, query)
-                print(formatter.format(res.columns, res.rows))
-                repl.update_with_result(res.query_metadata)
+                if args['--explain']:
+                    res = explain_query(engine, formatter, parser, query)
+                    print(formatter.format(res.columns, res.rows))
+                    metadata = res.query_metadata
+                else:
+                    metadata = execute_query_paged(engine, formatter, parser, query)
+                repl.update_with_result(metadata)
             except EOFError:
                 break
             except QueryError as e:
                 print('QueryError: {0}'.format(e))
+            except KeyboardInterrupt:
+                # tables being loaded are kept as they were, back to the prompt
+                print('Cancelled')
             except:
                 traceback.print_exc()
 
 
-def execute_query(engine, formatter, parser, query):
+def execute_query(engine, formatter, parser, query, columnar=False):
+    """
+    Parse and execute given query.
+
+    :param columnar: fetch the result as columns, the result `rows` is then a list of each column's values
+                     as typed arrays for numeric columns (or NumPy arrays if NumPy is installed)
+    """
     parsed_query, metadata = parser.parse_query(query)
-    columns, rows = engine.execute(parsed_query, metadata)
+    columns, rows = engine.execute(parsed_query, metadata, columnar=columnar)
     return QueryResult(parsed_query=parsed_query, query_metadata=metadata,
                        columns=columns, rows=rows)
+
+
+def execute_query_paged(engine, formatter, parser, query):
+    """
+    Execute given query and show its result, through a pager if it has more than `PAGED_RESULT_MIN_ROWS` rows.
+    Large results are formatted and paged as their rows are fetched so their first rows are shown right away,
+    and the rest of the rows is not fetched if the pager is quit before the end.
+
+    :return: the query metadata
+    """
+    parsed_query, metadata = parser.parse_query(query)
+    cursor = engine.execute_cursor(parsed_query, metadata)
+    columns = [d[0] for d in cursor.description]
+    rows = engine.fetch_rows(cursor)
+    first_rows = list(itertools.islice(rows, PAGED_RESULT_MIN_ROWS))
+    if len(first_rows) < PAGED_RESULT_MIN_ROWS:
+        print(formatter.format(columns, first_rows))
+    else:
+        util.page(formatter.format_chunks(columns, first_rows, rows))
+    return metadata
+
+
+def explain_query(engine, formatter, parser, query):
+    """
+    Parse given query and explain how its tables would be loaded, without loading them nor executing it.
+    """
+    parsed_query, metadata = parser.parse_query(query)
+    columns, rows = engine.explain(metadata)
+    return QueryResult(parsed_query=parsed_query, query_metadata=metadata,
+                       columns=columns, rows=rows)
+
+
+def execute_batch(engine, formatter, parser, queries_file, output_dir=None, explain=False):
+    """
+    Execute all queries in given file. All queries are parsed first so the tables needed by all of them
+    can be loaded at once, each only once and in parallel, before executing them.
+
+    :param explain: explain each query instead of executing it, loading no table, see `explain_query`
+    """
+    with open(queries_file) as f:
+        queries = split_statements(f.read())
+    parsed_queries = [parser.parse_query(query) for query in queries]
+    if not explain:
+        load_batch_tables(engine, parsed_queries)
+
+    if output_dir:
+        util.ensure_dir_exists(output_dir)
+    for i, (parsed_query, metadata) in enumerate(parsed_queries, start=1):
+        try:
+            if explain:
+                columns, rows = engine.explain(metadata)
+            else:
+                columns, rows = engine.execute(parsed_query, metadata)
+            output = formatter.format(columns, rows)
+        except QueryError as e:
+            output = 'QueryError: {0}'.format(e)
+        if output_dir:
+            output_file = os.path.join(output_dir, '{0:03d}.txt'.format(i))
+            with open(output_file, 'w') as f:
+                f.write('-- {0}\n{1}\n'.format(queries[i - 1], output))
+        else:
+            print('-- {0}'.format(queries[i - 1]))
+            print(output)
+            print()
+
+
+def load_batch_tables(engine, parsed_queries):
+    """
+    Load the tables needed by all given parsed queries at once, see `execute_batch`.
+    """
+    # materialized views created by the batch itself are computed when their statement is executed
+    created_views = set((m.materialized_view.database or engine.default_region, m.materialized_view.name)
+                        for _, m in parsed_queries if m.materialized_view is not None)
+    try:
+        engine.load_query_tables([
+            metadata._replace(tables=[t for t in metadata.tables
+                                      if (t.database or engine.default_region, t.table) not in created_views])
+            for _, metadata in parsed_queries])
+    except QueryError as e:
+        # each query loads its own tables then, so only the queries of the failing tables report the error
+        LOGGER.warning('Unable to load the tables of all queries at once: %s', e)
@@ -0,0 +1,135 @@
+"""
+Asyncio API to use aq as a library, e.g.
+
+    engine = AsyncEngine({'--region': 'us-east-1'})
+    result = await engine.query("SELECT id, instance_type FROM ec2_instances")
+    async for row in result:
+        print(row)
+
+This module needs Python 3.6 or later.
+
+Tables are fetched from AWS concurrently on a pool of worker threads while all SQLite work happens on
+a single dedicated thread, as SQLite connections cannot be shared between threads. Concurrent queries
+share the tables loaded (or being loaded) by each other.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from aq import get_engine, get_parser
+from aq.engines import TableLoad
+from aq.logger import get_logger
+
+LOGGER = get_logger()
+
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_BATCH_SIZE = 500
+
+
+class AsyncEngine(object):
+    def __init__(self, options=None, fetch_workers=DEFAULT_FETCH_WORKERS):
+        self.options = options if options else {}
+        self.parser = get_parser(self.options)
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+        self.fetch_executor = ThreadPoolExecutor(max_workers=fetch_workers)
+        self._engine = None
+        self._engine_future = None
+        # in-flight tables loading, keyed by (region, table name, limit, fetch filter), so they can be shared
+        # by callers
+        self._loading_tables = {}
+
+    async def query(self, query, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Execute given query, loading its tables as needed.
+
+        :return: `AsyncQueryResult` to iterate over the result rows
+        """
+        parsed_query, metadata = self.parser.parse_query(query)
+        engine = await self.get_engine()
+        # materialized views are refreshed along with the query execution, from the db thread
+        _, tables_metadata = await self.run_db(engine.split_materialized_views, metadata)
+        await asyncio.gather(*[self.load_table(engine, table, tables_metadata) for table in tables_metadata.tables])
+        cursor = await self.run_db(engine.execute_cursor, parsed_query, metadata)
+        return AsyncQueryResult(self, engine, cursor, batch_size)
+
+    async def get_engine(self):
+        if self._engine is None:
+            if self._engine_future is None:
+                # the engine (and so its connections) must be created on the db thread
+                self._engine_future = asyncio.ensure_future(self.run_db(get_engine, self.options))
+            self._engine = await self._engine_future
+        return self._engine
+
+    async def load_table(self, engine, table, metadata):
+        """
+        Load the rows of given table needed by the query of given metadata, unless they are already being loaded.
+        """
+        region, table_name = engine.resolve_table(table)
+        # finding the filter can need the table's boto3 resource, which is not built on the db thread
+        fetch_filter = await self.run_fetch(engine.get_fetch_filter, region, table_name, metadata)
+        load = TableLoad(engine.get_fetch_limit(metadata), fetch_filter,
+                         metadata.predicates if fetch_filter is not None else ())
+        key = (region, table_name, load.limit, load.fetch_filter)
+        future = self._loading_tables.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.refresh_table(engine, region, table_name, load))
+            self._loading_tables[key] = future
+            future.add_done_callback(lambda _: self._loading_tables.pop(key, None))
+        # one cancelled caller should not cancel the loading for others
+        await asyncio.shield(future)
+
+    async def refresh_table(self, engine, region, table_name, load):
+        schema_name = await self.run_db(engine.attach_storage, region, table_name)
+        if await self.run_db(engine.is_fresh_enough, schema_name, table_name, load.limit, load.fetch_filter):
+            return
+        LOGGER.info('Refreshing table: %s.%s', schema_name, table_name)
+        resource, collection = await self.run_fetch(engine.get_table_collection, region, table_name, load.predicates)
+        columns, items, fetch_seconds = await self.run_fetch(engine.fetch_table, resource, collection, load.limit)
+        await self.run_db(engine.store_table, schema_name, table_name, columns, items, load.limit, fetch_seconds,
+                          load.fetch_filter)
+
+    def run_db(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.db_executor, functools.partial(func, *args))
+
+    def run_fetch(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.fetch_executor, functools.partial(func, *args))
+
+    def close(self):
+        self.fetch_executor.shutdown(wait=True)
+        self.db_executor.shutdown(wait=True)
+
+
+class AsyncQueryResult(object):
+    """
+    Async iterator over the rows of a query result, fetched in batches from the db thread.
+    """
+
+    def __init__(self, async_engine, engine, cursor, batch_size=DEFAULT_BATCH_SIZE):
+        self.async_engine = async_engine
+        self.engine = engine
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.columns = [d[0] for d in cursor.description]
+        self._batch = []
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch:
+            if self._exhausted:
+                raise StopAsyncIteration
+            batch = await self.async_engine.run_db(self.engine.fetch_batch, self.cursor, self.batch_size)
+            if len(batch) < self.batch_size:
+                self._exhausted = True
+            if not batch:
+                raise StopAsyncIteration
+            # reverse so we can pop rows in order
+            self._batch = batch[::-1]
+        return self._batch.pop()
+
+    async def fetchall(self):
+        return [row async for row in self]
@@ -0,0 +1,61 @@
+"""
+Column-oriented query results.
+
+Numeric columns are built directly from the cursor, batch by batch, into typed `array.array` buffers
+(or NumPy arrays when NumPy is installed) which take a fraction of the memory of a list of row tuples.
+Columns with any non-numeric value (including NULL) are kept as plain lists.
+"""
+import array
+
+from six import integer_types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_BATCH_SIZE = 1000
+
+INTEGER_TYPES = set(integer_types)
+NUMERIC_TYPES = INTEGER_TYPES | {float}
+
+
+class ColumnBuilder(object):
+    def __init__(self):
+        self.values = array.array('q')
+
+    def extend(self, values):
+        if isinstance(self.values, array.array):
+            value_types = set(type(v) for v in values)
+            if value_types <= INTEGER_TYPES:
+                pass
+            elif value_types <= NUMERIC_TYPES:
+                if self.values.typecode == 'q':
+                    self.values = array.array('d', self.values)
+            else:
+                self.values = list(self.values)
+        self.values.extend(values)
+
+    def build(self, use_numpy=True):
+        if use_numpy and numpy is not None and isinstance(self.values, array.array):
+            # no copy, the numpy array uses the array buffer directly
+            dtype = numpy.int64 if self.values.typecode == 'q' else numpy.float64
+            return numpy.frombuffer(self.values, dtype=dtype)
+        return self.values
+
+
+def fetch_columns(cursor, batch_size=DEFAULT_BATCH_SIZE, use_numpy=True):
+    """
+    Fetch all rows of given cursor into columns.
+
+    :return: tuple of the columns list and the list of each column's values, in the same order
+    """
+    columns = [d[0] for d in cursor.description]
+    builders = [ColumnBuilder() for _ in columns]
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for builder, values in zip(builders, zip(*batch)):
+            builder.extend(values)
+    return columns, [builder.build(use_numpy) for builder in builders]
@@ -1,24 +1,95 @@
+import fnmatch
 import itertools
+import json
 import os.path
 import pprint
+import re
 import sqlite3
+import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 from multiprocessing.dummy import Pool
 
 import boto3
+from boto3.exceptions import ResourceNotExistsError
+from boto3.resources.base import ServiceResource
 from boto3.resources.collection import CollectionManager
+from botocore import xform_name
 from botocore.exceptions import NoCredentialsError
+from six import string_types
 
 from aq import logger, util, sqlite_util
-from aq.errors import QueryError
+from aq import columnar as columnar_util
+from aq.errors import AQError, QueryError
+from aq.parsers import QueryMetadata, TableId
 
 DEFAULT_REGION = 'us_east_1'
 
+# suffix of the views exposing snapshots history of a table, e.g. ec2_instances_history
+SNAPSHOT_HISTORY_SUFFIX = '_history'
+
+# names of the tables aq keeps along the tables of AWS resources: the tables metadata (e.g. aq_tables),
+# the snapshots tables and history views and the tables of interned JSON values
+RESERVED_TABLE_PREFIX = 'aq_'
+RESERVED_TABLE_SUFFIXES = (SNAPSHOT_HISTORY_SUFFIX, '_versions', '_snapshot_rows', '_data', '_values')
+
+# settings of the read-only connection used for queries that can be answered from cache only
+READ_ONLY_MMAP_SIZE = 1024 * 1024 * 1024
+READ_ONLY_CACHE_SIZE_KB = 64 * 1024
+
+# actions to get the tables of a query, see BotoSqliteEngine.get_fetch_plan
+USE_CACHE = 'use cache'
+FETCH = 'fetch'
+USE_STALE_CACHE = 'use stale cache'
+OVER_BUDGET = 'over budget'
+
+# number of rows to sample to find the keys of JSON object columns
+CATALOG_SAMPLE_SIZE = 500
+
+# max number of tables to fetch from AWS at the same time
+MAX_FETCH_WORKERS = 8
+
+# bounds of the adaptive cache ttl of a table, in seconds
+ADAPTIVE_TTL_MIN = 60
+ADAPTIVE_TTL_MAX = 24 * 3600
+# share of changed rows between two refreshes above which a table is considered volatile
+VOLATILE_CHANGE_RATIO = 0.1
+
+# filters of the sub-collections that the query predicates can be pushed down to, keyed by service name,
+# sub-collection name and column, e.g. the prefix of the keys of the objects of S3 buckets
+SUB_COLLECTION_FILTERS = {
+    ('s3', 'objects', 'key'): 'Prefix',
+    ('s3', 'object_versions', 'object_key'): 'Prefix',
+    ('s3', 'multipart_uploads', 'object_key'): 'Prefix',
+}
+
+# number of SQLite virtual machine instructions between checks of the query deadline
+PROGRESS_HANDLER_INSTRUCTIONS = 10000
+
+# top-level collection of the tables of ParentScopedCollection (None for other tables), keyed by table name,
+# see BotoSqliteEngine.get_parent_collection
+PARENT_COLLECTIONS = {}
+
+# locks held by the engines of the process (e.g. the REPL's and its prefetcher's) while loading a table,
+# so a table being loaded by one engine is waited for by the others instead of being fetched again,
+# keyed by (engine type, data dir, region, table name)
+TABLE_LOAD_LOCKS = defaultdict(threading.Lock)
+# locks held while writing to a database, so engines of the process write to it one at a time instead of
+# failing (or timing out) on its write lock, keyed by (engine type, data dir, schema name)
+STORAGE_WRITE_LOCKS = defaultdict(threading.Lock)
+PROCESS_LOCKS_LOCK = threading.Lock()
+
+# rows of a table to load for a query: its first `limit` rows (all rows if None), or only its rows matching
+# `fetch_filter` (see BotoSqliteEngine.get_fetch_filter) fetched with the query `predicates`
+TableLoad = namedtuple('TableLoad', ('limit', 'fetch_filter', 'predicates'))
+
 LOGGER = logger.get_logger()
 
 
 class BotoSqliteEngine(object):
+    # whether tables can be loaded by another engine of the process while this one is querying
+    supports_background_loading = True
+
     def __init__(self, options=None):
         self.options = options if options else {}
         self.debug = options.get('--debug', False)
@@ -26,7 +97,21 @@ class BotoSqliteEngine(object):
         self.profile = options.get('--profile', None)
         self.region = options.get('--region', None)
         self.table_cache_ttl = int(options.get('--table-cache-ttl', 300))
-        self.last_refresh_time = defaultdict(int)
+        self.table_ttls = parse_table_ttls(options.get('--table-ttls'))
+        self.adaptive_ttl = options.get('--adaptive-ttl', False)
+        max_fetch_seconds = options.get('--max-fetch-seconds')
+        self.max_fetch_seconds = float(max_fetch_seconds) if max_fetch_seconds else None
+        sample_size = options.get('--sample')
+        self.sample_size = int(sample_size) if sample_size else None
+        # snapshots are always of whole tables so they are not kept for samples
+        self.keep_snapshots = options.get('--snapshots', False) and self.sample_size is None
+        # samples are kept apart from whole tables so they are never mistaken for each other
+        self.data_dir = os.path.expanduser('~/.aq/sample' if self.sample_size else '~/.aq')
+        self.intern_json = options.get('--intern-json', False)
+        query_timeout = options.get('--query-timeout')
+        self.query_timeout = float(query_timeout) if query_timeout else None
+        # time after which the running query is interrupted, if any
+        self.query_deadline = None
 
         self.boto3_session = boto3.Session(profile_name=self.profile)
         # dash (-) is not allowed in database name so we use underscore (_) instead in region name
@@ -39,84 +124,729 @@ class BotoSqliteEngine(object):
             self.default_region = DEFAULT_REGION
 
         self.boto3_session = boto3.Session(profile_name=self.profile, region_name=self.default_region.replace('_', '-'))
+        self.session_lock = threading.Lock()
         self.db = self.init_db()
+        self.db.set_progress_handler(self.is_past_query_deadline, PROGRESS_HANDLER_INSTRUCTIONS)
         # attach the default region too
         self.attach_region(self.default_region)
+        # read-only connection for queries on cached tables only, opened on first use
+        self.read_only_db = None
 
     def init_db(self):
         util.ensure_data_dir_exists()
-        db_path = '~/.aq/{0}.db'.format(self.default_region)
-        absolute_path = os.path.expanduser(db_path)
-        return sqlite_util.connect(absolute_path)
+        util.ensure_dir_exists(self.data_dir)
+        return sqlite_util.connect(self.region_db_file_path(self.default_region))
+
+    def init_read_only_db(self):
+        return sqlite_util.connect_readonly(self.region_db_file_path(self.default_region),
+                                            mmap_size=READ_ONLY_MMAP_SIZE,
+                                            cache_size=READ_ONLY_CACHE_SIZE_KB)
+
+    def region_db_file_path(self, region):
+        return os.path.join(self.data_dir, '{0}.db'.format(region))
+
+    def execute(self, query, metadata, columnar=False):
+        """
+        Execute given query and fetch all of its result.
 
-    def execute(self, query, metadata):
+        :param columnar: return the result as a list of columns instead of a list of rows,
+                         see `aq.columnar.fetch_columns`
+        :return: tuple of the columns list and the result rows (or columns)
+        """
+        cursor = self.execute_cursor(query, metadata)
+        if columnar:
+            return self.run_until_deadline(columnar_util.fetch_columns, cursor)
+        columns = [d[0] for d in cursor.description]
+        rows = self.run_until_deadline(cursor.fetchall)
+        return columns, rows
+
+    def execute_cursor(self, query, metadata):
+        """
+        Execute given query and return the cursor to fetch its result from.
+        With a query timeout, fetching each batch of the result is also interrupted past the timeout,
+        see `fetch_batch`.
+        """
         LOGGER.info('Executing query: %s', query)
-        self.load_tables(query, metadata)
+        if metadata.materialized_view is not None:
+            return self.create_materialized_view(query, metadata)
+        views, metadata = self.split_materialized_views(metadata)
+        for region, view_name, view in views:
+            self.refresh_materialized_view(region, view_name, view)
+        if self.is_cached_query(metadata):
+            LOGGER.info('All tables are fresh, executing query on read-only connection')
+            db = self.get_read_only_db(metadata)
+            for region, _, _ in views:
+                self.attach_storage(region, None, read_only=True)
+        else:
+            self.load_tables(query, metadata)
+            db = self.db
+        query = self.rewrite_query(query, metadata)
+        return self.run_until_deadline(db.execute, query)
+
+    def fetch_rows(self, cursor, batch_size=1000):
+        """
+        Iterate over the result rows of given cursor, fetched batch by batch as they are consumed.
+        """
+        while True:
+            batch = self.fetch_batch(cursor, batch_size)
+            if not batch:
+                break
+            for row in batch:
+                yield row
+
+    def fetch_batch(self, cursor, batch_size):
+        """
+        Fetch the next batch of result rows of given cursor, an empty batch once all rows are fetched.
+        The query timeout only counts the time spent fetching the batch, not the time the previous batches
+        were waiting to be consumed, e.g. shown in a pager.
+        """
+        return self.run_until_deadline(cursor.fetchmany, batch_size)
+
+    def run_until_deadline(self, func, *args):
+        """
+        Call given function running a query, interrupted past the query timeout counted from now.
+        """
+        if self.query_timeout is not None:
+            self.query_deadline = time.time() + self.query_timeout
         try:
-            cursor = self.db.execute(query)
+            return func(*args)
         except sqlite3.OperationalError as e:
-            raise QueryError(str(e))
-        columns = [d[0] for d in cursor.description]
-        rows = cursor.fetchall()
-        return columns, rows
+            raise self.query_error(e)
+        finally:
+            self.query_deadline = None
+
+    def is_past_query_deadline(self):
+        # SQLite progress handler, a true return value interrupts the running query.
+        # As a Python callback, it's also where a pending Ctrl-C interrupts the query
+        return self.query_deadline is not None and time.time() > self.query_deadline
+
+    def query_error(self, error):
+        if str(error) != 'interrupted':
+            return QueryError(str(error))
+        if self.is_past_query_deadline():
+            return QueryError('Query timed out after {0} seconds'.format(self.query_timeout))
+        return QueryError('Query interrupted')
+
+    def rewrite_query(self, query, meta):
+        """
+        Rewrite given query to be executed against the storage of its tables.
+        Tables are stored in their region schema so there is nothing to rewrite by default.
+        """
+        return query
 
     def load_tables(self, query, meta):
         """
         Load necessary resources tables into db to execute given query.
+        Each distinct table is loaded only once and stale tables are fetched from AWS in parallel.
+        Materialized views are refreshed instead, see `refresh_materialized_view`.
         """
-        try:
+        self.load_query_tables([meta])
+
+    def load_query_tables(self, metadata_list):
+        """
+        Load the tables needed by all given queries at once, see `load_tables`.
+        A table needed by multiple queries is loaded once with enough rows for all of them, see `merge_table_loads`.
+        """
+        # loads of each table needed by the queries, keyed by (region, table name)
+        table_loads = OrderedDict()
+        for meta in metadata_list:
+            views, meta = self.split_materialized_views(meta)
+            for region, view_name, view in views:
+                self.refresh_materialized_view(region, view_name, view)
+            limit = self.get_fetch_limit(meta)
             for table in meta.tables:
-                self.load_table(table)
+                region, table_name = self.resolve_table(table)
+                fetch_filter = self.get_fetch_filter(region, table_name, meta)
+                predicates = meta.predicates if fetch_filter is not None else ()
+                table_loads.setdefault((region, table_name), []).append(TableLoad(limit, fetch_filter, predicates))
+
+        # load of each stale table, keyed by (region, table name)
+        stale_tables = OrderedDict()
+        for (region, table_name), loads in table_loads.items():
+            load = merge_table_loads(loads)
+            if load is None:
+                LOGGER.info('Table %s.%s is left for each query to load as they need different rows of it',
+                            region, table_name)
+                continue
+            schema_name = self.attach_storage(region, table_name)
+            action, estimated_seconds = self.get_fetch_plan(schema_name, table_name, load.limit, load.fetch_filter)
+            if action == FETCH:
+                stale_tables[(region, table_name)] = load
+            elif action == USE_STALE_CACHE:
+                LOGGER.warning('Using stale table %s.%s as fetching it should take %.1f seconds',
+                               region, table_name, estimated_seconds)
+            elif action == OVER_BUDGET:
+                raise QueryError('Fetching table {0}.{1} should take {2:.1f} seconds, more than the max fetch '
+                                 'time of {3} seconds'.format(region, table_name, estimated_seconds,
+                                                              self.max_fetch_seconds))
+        if not stale_tables:
+            return
+
+        # tables being loaded by another engine of the process, e.g. the REPL prefetcher's, are waited for
+        # instead of being fetched again
+        load_locks = []
+        try:
+            for (region, table_name), load in list(stale_tables.items()):
+                load_lock = self.get_table_load_lock(region, table_name)
+                load_lock.acquire()
+                load_locks.append(load_lock)
+                schema_name = self.attach_storage(region, table_name)
+                if self.is_fresh_enough(schema_name, table_name, load.limit, load.fetch_filter):
+                    del stale_tables[(region, table_name)]
+            if stale_tables:
+                self.fetch_tables(stale_tables)
+        finally:
+            for load_lock in load_locks:
+                load_lock.release()
+
+    def fetch_tables(self, stale_tables):
+        """
+        Fetch given tables from AWS in parallel and store them as they are fetched.
+
+        :param stale_tables: dict of (region, table name) to the `TableLoad` of the table
+        """
+        # set to stop the fetches still running when we stop waiting for them, e.g. on Ctrl-C
+        cancel_event = threading.Event()
+
+        def fetch(key):
+            load = stale_tables[key]
+            resource, collection = self.get_table_collection(key[0], key[1], load.predicates)
+            LOGGER.info('Fetching table: %s.%s', *key)
+            return key, self.fetch_table(resource, collection, load.limit, cancel_event)
+
+        pool = Pool(processes=min(len(stale_tables), MAX_FETCH_WORKERS))
+        try:
+            for (region, table_name), (columns, items, fetch_seconds) in pool.imap_unordered(fetch, stale_tables):
+                load = stale_tables[(region, table_name)]
+                # attach again as the table database could have been detached to attach the others
+                schema_name = self.attach_storage(region, table_name)
+                self.store_table(schema_name, table_name, columns, items, load.limit, fetch_seconds,
+                                 load.fetch_filter)
         except NoCredentialsError:
             help_link = 'http://boto3.readthedocs.io/en/latest/guide/configuration.html'
             raise QueryError('Unable to locate AWS credential. '
                              'Please see {0} on how to configure AWS credential.'.format(help_link))
+        finally:
+            cancel_event.set()
+            pool.close()
+
+    def is_cached_query(self, meta):
+        """
+        Check if given query can be executed with the cached tables only, i.e. all tables are fresh.
+        """
+        limit = self.get_fetch_limit(meta)
+        for table in meta.tables:
+            region, table_name = self.resolve_table(table)
+            schema_name = self.attach_storage(region, table_name)
+            fetch_filter = self.get_fetch_filter(region, table_name, meta)
+            if not self.is_fresh_enough(schema_name, table_name, limit, fetch_filter):
+                return False
+        return True
+
+    def get_fetch_plan(self, schema_name, table_name, limit=None, fetch_filter=None):
+        """
+        Decide how to get given table for a query needing `limit` rows of it (or all rows if None),
+        or only its rows matching `fetch_filter` (see `get_fetch_filter`).
+
+        :return: tuple of the action, one of `USE_CACHE`, `FETCH`, `USE_STALE_CACHE` (fetching is estimated to
+                 take longer than the max fetch time) or `OVER_BUDGET` (same but there is no cache to use),
+                 and the estimated fetch time in seconds (None if unknown)
+        """
+        table_meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+        if self.is_fresh_enough(schema_name, table_name, limit, fetch_filter):
+            return USE_CACHE, 0
+        estimated_seconds = estimate_fetch_seconds(table_meta, limit)
+        if self.max_fetch_seconds is None or estimated_seconds is None or estimated_seconds <= self.max_fetch_seconds:
+            return FETCH, estimated_seconds
+        if is_cached(table_meta, limit, fetch_filter):
+            return USE_STALE_CACHE, estimated_seconds
+        return OVER_BUDGET, estimated_seconds
+
+    def explain(self, meta):
+        """
+        Explain how the tables of given query would be loaded, without loading them.
+        Tables are fetched in parallel so the query should wait about as long as the longest fetch.
+
+        :return: tuple of the columns list and the rows, one per table
+        """
+        # materialized views are explained by the tables they are computed from
+        views, meta = self.split_materialized_views(meta)
+        dependencies = self.get_transitive_dependencies([d for _, _, view in views for d in view['dependencies']])
+        _, dependencies_meta = self.split_materialized_views(
+            QueryMetadata(tables=[TableId(region, table_name, None) for region, table_name in sorted(dependencies)]))
+        meta = meta._replace(tables=list(meta.tables) + dependencies_meta.tables)
+
+        limit = self.get_fetch_limit(meta)
+        columns = ['table', 'action', 'cache_age_seconds', 'cached_rows', 'estimated_fetch_seconds']
+        rows = []
+        for region, table_name in OrderedDict((self.resolve_table(t), True) for t in meta.tables):
+            schema_name = self.attach_storage(region, table_name)
+            fetch_filter = self.get_fetch_filter(region, table_name, meta)
+            action, estimated_seconds = self.get_fetch_plan(schema_name, table_name, limit, fetch_filter)
+            table_meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+            age = None
+            rows_count = None
+            if is_cached(table_meta):
+                age = round(time.time() - table_meta['refreshed_at'], 1)
+                rows_count = table_meta['row_count']
+            if estimated_seconds is not None:
+                estimated_seconds = round(estimated_seconds, 1)
+            rows.append(('{0}.{1}'.format(region, table_name), action, age, rows_count, estimated_seconds))
+        return columns, rows
+
+    def split_materialized_views(self, meta):
+        """
+        Split the materialized views out of the tables of given query.
+
+        :return: tuple of the list of the (region, view name, view definition) of its materialized views
+                 and the query metadata without them
+        """
+        views = []
+        tables = []
+        for table in meta.tables:
+            region = table.database if table.database else self.default_region
+            # views are kept in their region database, whatever the storage of tables
+            schema_name = self.attach_storage(region, None)
+            view = sqlite_util.get_materialized_view(self.db, schema_name, table.table)
+            if view is None:
+                tables.append(table)
+            else:
+                views.append((region, table.table, view))
+        return views, meta._replace(tables=tables)
+
+    def create_materialized_view(self, query, meta):
+        """
+        Create (or replace) the materialized view of given query, i.e. store its result as a table
+        that is recomputed when any of the tables it's computed from is refreshed.
+
+        :return: cursor over the view name and its number of rows
+        """
+        view = meta.materialized_view
+        region = view.database if view.database else self.default_region
+        if view.name.startswith(RESERVED_TABLE_PREFIX) or view.name.endswith(RESERVED_TABLE_SUFFIXES):
+            raise QueryError('Materialized view name {0} is reserved for the tables of aq'.format(view.name))
+        if self.is_aws_table(region, view.name):
+            # the view would replace the cached table and hide it from then on
+            raise QueryError('Materialized view name {0} is the name of an AWS table'.format(view.name))
+        dependencies = list(OrderedDict(((t.database if t.database else self.default_region, t.table), True)
+                                        for t in meta.tables))
+        if (region, view.name) in self.get_transitive_dependencies(dependencies):
+            raise QueryError('Materialized view {0}.{1} cannot be computed from itself'.format(region, view.name))
+        definition = {
+            # the default region is resolved now so the view is always computed from the same tables
+            'query': qualify_table_names(query, meta.tables, self.default_region),
+            'dependencies': dependencies,
+            'index_columns': list(view.index_columns),
+        }
+        self.refresh_materialized_view(region, view.name, definition, force=True)
+        schema_name = self.attach_storage(region, None)
+        return self.db.execute('SELECT ? AS materialized_view, count(*) AS row_count FROM {0}.{1}'
+                               .format(schema_name, view.name), ('{0}.{1}'.format(region, view.name),))
+
+    def is_aws_table(self, region, table_name):
+        """
+        Check if given table name is the name of a table of AWS resources, see `get_table_collection`.
+        """
+        try:
+            self.get_table_collection(region, table_name)
+        except QueryError:
+            return False
+        return True
+
+    def get_transitive_dependencies(self, dependencies):
+        """
+        Get given tables and, for the materialized views among them, all the tables they are computed from.
+
+        :param dependencies: list of (region, table name)
+        :return: set of (region, table name)
+        """
+        found = set()
+        pending = list(dependencies)
+        while pending:
+            region, table_name = pending.pop()
+            if (region, table_name) in found:
+                continue
+            found.add((region, table_name))
+            if self.has_storage(region, None):
+                view = sqlite_util.get_materialized_view(self.db, self.attach_storage(region, None), table_name)
+                if view is not None:
+                    pending.extend(view['dependencies'])
+        return found
+
+    def refresh_materialized_view(self, region, view_name, view, force=False):
+        """
+        Recompute given materialized view if any of its tables was refreshed since it was last computed,
+        after loading its stale tables (and refreshing the materialized views it's computed from).
+
+        :param view: the view definition, see `sqlite_util.get_materialized_view`
+        :param force: recompute the view even if its tables were not refreshed
+        """
+        tables_meta = get_dependencies_metadata(view)
+        self.load_tables(None, tables_meta)
+
+        schema_name = self.attach_storage(region, None)
+        view_meta = sqlite_util.get_table_meta(self.db, schema_name, view_name)
+        if not force and view_meta is not None:
+            tables_refreshed_at = [self.get_refreshed_at(t) for t in tables_meta.tables]
+            if all(r is not None and r <= view_meta['refreshed_at'] for r in tables_refreshed_at):
+                return
+
+        LOGGER.info('Computing materialized view: %s.%s', schema_name, view_name)
+        # the view's own materialized views are not rewritten as they are kept in their region database
+        _, storage_meta = self.split_materialized_views(tables_meta)
+        query = self.rewrite_query(view['query'], storage_meta)
+        # attach again as the view database could have been detached to attach its tables
+        schema_name = self.attach_storage(region, None)
+        try:
+            with self.get_storage_write_lock(schema_name), sqlite_util.transaction(self.db):
+                sqlite_util.create_table_as(self.db, schema_name, view_name, query, view['index_columns'])
+                sqlite_util.set_materialized_view(self.db, schema_name, view_name, view['query'],
+                                                  view['dependencies'], view['index_columns'])
+                sqlite_util.ensure_table_meta(self.db, schema_name)
+                sqlite_util.set_table_meta(self.db, schema_name, view_name, refreshed_at=time.time())
+        except sqlite3.OperationalError as e:
+            raise self.query_error(e)
+
+    def get_refreshed_at(self, table):
+        """
+        Time given table or materialized view was last refreshed, None if never.
+        """
+        views, _ = self.split_materialized_views(QueryMetadata(tables=[table]))
+        if views:
+            region, table_name = views[0][0], table.table
+            schema_name = self.attach_storage(region, None)
+        else:
+            region, table_name = self.resolve_table(table)
+            schema_name = self.attach_storage(region, table_name)
+        table_meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+        return table_meta['refreshed_at'] if table_meta else None
+
+    def get_fetch_filter(self, region, table_name, meta):
+        """
+        Filter of the rows of given table that are enough to answer given query, from the query predicates that
+        can be pushed down to AWS, e.g. the buckets of `s3_bucket_objects`.
+
+        :return: the filter, as a JSON string to record it in the table metadata, or None to fetch all rows
+        """
+        if not meta.predicates or self.keep_snapshots or table_name.endswith(SNAPSHOT_HISTORY_SUFFIX):
+            # snapshots are always of the whole table
+            return None
+        if self.get_parent_collection(table_name) is None:
+            # only collections of the resources of a top-level collection can be filtered
+            return None
+        _, collection = self.get_table_collection(region, table_name, meta.predicates)
+        if not isinstance(collection, ParentScopedCollection) or not collection.pushed_down_filter:
+            return None
+        return json.dumps(collection.pushed_down_filter, sort_keys=True)
+
+    def get_parent_collection(self, table_name):
+        """
+        Name of the top-level collection of given table if it's a collection of the resources of a top-level
+        collection, see `ParentScopedCollection`, None otherwise.
+        Building the boto3 resource of the table is slow so this is only looked up once per table name.
+        """
+        if table_name not in PARENT_COLLECTIONS:
+            resource_name, _, collection_name = table_name.partition('_')
+            try:
+                with self.session_lock:
+                    resource = self.boto3_session.resource(resource_name)
+            except ResourceNotExistsError:
+                parent_collection_name = None
+            else:
+                parent_collection_name = None if hasattr(resource, collection_name) \
+                    else find_parent_collection(resource, collection_name)
+            PARENT_COLLECTIONS[table_name] = parent_collection_name
+        return PARENT_COLLECTIONS[table_name]
+
+    def get_fetch_limit(self, meta):
+        """
+        Number of rows to fetch for the tables of given query, None to fetch all rows.
+        """
+        if self.sample_size is not None:
+            return min(self.sample_size, meta.limit) if meta.limit is not None else self.sample_size
+        if self.keep_snapshots or any(t.table.endswith(SNAPSHOT_HISTORY_SUFFIX) for t in meta.tables):
+            # snapshots are always of the whole table
+            return None
+        return meta.limit
+
+    def get_read_only_db(self, meta):
+        if self.read_only_db is None:
+            self.read_only_db = self.init_read_only_db()
+            self.read_only_db.set_progress_handler(self.is_past_query_deadline, PROGRESS_HANDLER_INSTRUCTIONS)
+        for table in meta.tables:
+            region, table_name = self.resolve_table(table)
+            self.attach_storage(region, table_name, read_only=True)
+        return self.read_only_db
+
+    def resolve_table(self, table):
+        """
+        Resolve given table id to the (region, table name) of the table that need to be loaded for it.
+        """
+        region = table.database if table.database else self.default_region
+        table_name = table.table
+        if table_name.endswith(SNAPSHOT_HISTORY_SUFFIX):
+            # snapshots history is a view over the base table's snapshots
+            # so we just need to make sure the base table (and its latest snapshot) is loaded
+            table_name = table_name[:-len(SNAPSHOT_HISTORY_SUFFIX)]
+        return region, table_name
 
     def load_table(self, table):
         """
         Load resources as specified by given table into our db.
         """
-        region = table.database if table.database else self.default_region
-        resource_name, collection_name = table.table.split('_', 1)
+        region, table_name = self.resolve_table(table)
+        schema_name = self.attach_storage(region, table_name)
+        # only the sample of the table when sampling
+        limit = self.get_fetch_limit(QueryMetadata(tables=[table]))
+        # another engine of the process could be loading the table, see `load_tables`
+        with self.get_table_load_lock(region, table_name):
+            if self.is_fresh_enough(schema_name, table_name, limit):
+                return
+
+            resource, collection = self.get_table_collection(region, table_name)
+            self.refresh_table(schema_name, table_name, resource, collection, limit)
+
+    def get_table_load_lock(self, region, table_name):
+        with PROCESS_LOCKS_LOCK:
+            return TABLE_LOAD_LOCKS[(type(self), self.data_dir, region, table_name)]
+
+    def get_storage_write_lock(self, schema_name):
+        with PROCESS_LOCKS_LOCK:
+            return STORAGE_WRITE_LOCKS[(type(self), self.data_dir, schema_name)]
+
+    def get_table_collection(self, region, table_name, predicates=()):
+        """
+        Get the boto3 resource and its collection of given table.
+        Tables can also be collections of the resources of a top-level collection, e.g. `s3_bucket_objects`
+        for the objects of all buckets, see `ParentScopedCollection`.
+
+        :param predicates: predicates of the query on given table to push down to AWS, if possible
+        """
+        resource_name, _, collection_name = table_name.partition('_')
+        if not collection_name:
+            raise QueryError('Unknown table {0}, tables are named <resource>_<collection>'.format(table_name))
         # we use underscore "_" instead of dash "-" for region name but boto3 need dash
         boto_region_name = region.replace('_', '-')
-        resource = self.boto3_session.resource(resource_name, region_name=boto_region_name)
-        if not hasattr(resource, collection_name):
+        try:
+            # boto3 session is not thread-safe and tables can be fetched from multiple threads
+            with self.session_lock:
+                resource = self.boto3_session.resource(resource_name, region_name=boto_region_name)
+        except ResourceNotExistsError:
+            raise QueryError('Unknown resource <{0}>'.format(resource_name))
+        if hasattr(resource, collection_name):
+            return resource, getattr(resource, collection_name)
+        parent_collection_name = find_parent_collection(resource, collection_name)
+        if parent_collection_name is None:
             raise QueryError(
                 'Unknown collection <{0}> of resource <{1}>'.format(collection_name, resource_name))
+        collection = ParentScopedCollection(resource, parent_collection_name, collection_name)
+        collection.push_down(predicates)
+        return resource, collection
+
+    def storage_schema(self, region, table_name):
+        """
+        Name of the attached database (schema) where given table is stored.
+        """
+        return region
+
+    def storage_file_path(self, region, table_name):
+        """
+        Path of the database file where given table is stored.
+        """
+        return self.region_db_file_path(region)
+
+    def has_storage(self, region, table_name):
+        """
+        Check if the database storing given table exists, attaching it would create it otherwise.
+        """
+        return os.path.exists(self.storage_file_path(region, table_name))
 
-        self.attach_region(region)
-        self.refresh_table(region, table.table, resource, getattr(resource, collection_name))
+    def attach_storage(self, region, table_name, read_only=False):
+        """
+        Attach the database storing given table to our db (or our read-only db) if it's not attached yet.
+
+        :return: schema name of the attached database
+        """
+        db = self.read_only_db if read_only else self.db
+        schema_name = self.storage_schema(region, table_name)
+        if not self.is_attached_region(schema_name, db):
+            path = self.storage_file_path(region, table_name)
+            LOGGER.info('Attaching database %s as: %s', path, schema_name)
+            if read_only:
+                db.execute('ATTACH DATABASE ? AS ?', (sqlite_util.readonly_uri(path), schema_name))
+                sqlite_util.tune_readonly(db, schema_name,
+                                          mmap_size=READ_ONLY_MMAP_SIZE,
+                                          cache_size=READ_ONLY_CACHE_SIZE_KB)
+            else:
+                db.execute('ATTACH DATABASE ? AS ?', (path, schema_name))
+        return schema_name
 
     def attach_region(self, region):
         if not self.is_attached_region(region):
             LOGGER.info('Attaching new database for region: %s', region)
-            region_db_file_path = '~/.aq/{0}.db'.format(region)
-            absolute_path = os.path.expanduser(region_db_file_path)
-            self.db.execute('ATTACH DATABASE ? AS ?', (absolute_path, region))
+            self.db.execute('ATTACH DATABASE ? AS ?', (self.region_db_file_path(region), region))
 
-    def is_attached_region(self, region):
-        databases = self.db.execute('PRAGMA database_list')
+    def is_attached_region(self, region, db=None):
+        db = db if db is not None else self.db
+        databases = db.execute('PRAGMA database_list')
         db_names = (db[1] for db in databases)
         return region in db_names
 
-    def refresh_table(self, schema_name, table_name, resource, collection):
-        if not self.is_fresh_enough(schema_name, table_name):
+    def refresh_table(self, schema_name, table_name, resource, collection, limit=None):
+        if not self.is_fresh_enough(schema_name, table_name, limit):
             LOGGER.info('Refreshing table: %s.%s', schema_name, table_name)
-            columns = get_columns_list(resource, collection)
-            LOGGER.info('Columns list: %s', columns)
-            with self.db:
-                sqlite_util.create_table(self.db, schema_name, table_name, columns)
-                items = collection.all()
-                # special treatment for tags field
-                items = [convert_tags_to_dict(item) for item in items]
-                sqlite_util.insert_all(self.db, schema_name, table_name, columns, items)
-                self.last_refresh_time[(schema_name, table_name)] = time.time()
-
-    def is_fresh_enough(self, schema_name, table_name):
-        last_refresh = self.last_refresh_time[(schema_name, table_name)]
-        age = time.time() - last_refresh
-        return age < self.table_cache_ttl
+            columns, items, fetch_seconds = self.fetch_table(resource, collection, limit)
+            self.store_table(schema_name, table_name, columns, items, limit, fetch_seconds)
+
+    @staticmethod
+    def fetch_table(resource, collection, limit=None, cancel_event=None):
+        """
+        Fetch all resources (or only the first `limit` ones) of given collection from AWS.
+        This doesn't touch our db so it's safe to be called from any thread.
+
+        :param cancel_event: `threading.Event` to stop fetching, checked between pages
+        :return: tuple of the columns list, the list of fetched items and the fetch time in seconds
+        """
+        start_time = time.time()
+        columns = get_columns_list(resource, collection)
+        LOGGER.info('Columns list: %s', columns)
+        items = collection.all()
+        if limit is not None:
+            # stop paginating once we have enough items, page size is left to AWS defaults
+            # as the allowed page sizes are different between APIs
+            items = items.limit(limit)
+        fetched_items = []
+        for page in items.pages():
+            if cancel_event is not None and cancel_event.is_set():
+                raise QueryError('Fetching cancelled')
+            # special treatment for tags field
+            fetched_items.extend(convert_tags_to_dict(item) for item in page)
+        return columns, fetched_items, time.time() - start_time
+
+    def store_table(self, schema_name, table_name, columns, items, limit=None, fetch_seconds=None,
+                    fetch_filter=None):
+        """
+        Replace the content of schema_name.table_name in our db with given items.
+
+        :param limit: the limit used to fetch given items, if any, in which case the table is marked as partial
+        :param fetch_seconds: time taken to fetch given items, to estimate the time of the next fetches
+        :param fetch_filter: the filter used to fetch given items, if any, in which case the table is marked as
+                             filtered, see `get_fetch_filter`
+        """
+        try:
+            # the table is replaced all at once, or kept as it was if anything goes wrong
+            with self.get_storage_write_lock(schema_name), sqlite_util.transaction(self.db):
+                is_full_table = limit is None and fetch_filter is None
+                track_changes = self.adaptive_ttl and is_full_table
+                if track_changes:
+                    previous_row_hashes = self.get_full_table_row_hashes(schema_name, table_name, columns)
+                if self.intern_json:
+                    sqlite_util.create_interned_table(self.db, schema_name, table_name, columns, items)
+                else:
+                    sqlite_util.create_table(self.db, schema_name, table_name, columns)
+                    sqlite_util.insert_all(self.db, schema_name, table_name, columns, items)
+                if self.keep_snapshots:
+                    sqlite_util.create_snapshot_tables(self.db, schema_name, table_name, columns)
+                    snapshot_id = sqlite_util.insert_snapshot(self.db, schema_name, table_name, columns, items)
+                    LOGGER.info('Recorded snapshot %s of table: %s.%s', snapshot_id, schema_name, table_name)
+                sqlite_util.ensure_table_meta(self.db, schema_name)
+                sqlite_util.set_table_meta(self.db, schema_name, table_name, refreshed_at=time.time(),
+                                           fetch_limit=limit, fetch_filter=fetch_filter)
+                if is_full_table:
+                    # only full fetches are representative of the cost of fetching the table
+                    sqlite_util.set_table_meta(self.db, schema_name, table_name, row_count=len(items),
+                                               fetch_seconds=fetch_seconds)
+                if track_changes and previous_row_hashes is not None:
+                    row_hashes = sqlite_util.table_row_hashes(self.db, schema_name, table_name, columns)
+                    self.update_adaptive_ttl(schema_name, table_name, get_change_ratio(previous_row_hashes, row_hashes))
+        except sqlite3.OperationalError as e:
+            raise self.query_error(e)
+
+    def get_full_table_row_hashes(self, schema_name, table_name, columns):
+        """
+        Row hashes of the currently stored table, or None if it's not stored or only partially.
+        """
+        meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+        if not is_cached(meta):
+            return None
+        return sqlite_util.table_row_hashes(self.db, schema_name, table_name, columns)
+
+    def update_adaptive_ttl(self, schema_name, table_name, change_ratio):
+        """
+        Lengthen the ttl of a table that didn't change since its last refresh and shorten it if it changed a lot.
+        """
+        meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+        base_ttl = self.get_configured_ttl(table_name)
+        ttl = meta['ttl'] if meta['ttl'] is not None else base_ttl
+        if change_ratio == 0:
+            ttl = min(ttl * 2, max(ADAPTIVE_TTL_MAX, base_ttl))
+        elif change_ratio > VOLATILE_CHANGE_RATIO:
+            ttl = max(ttl // 2, min(ADAPTIVE_TTL_MIN, base_ttl))
+        LOGGER.info('Table %s.%s changed by %.1f%%, ttl is now %s seconds',
+                    schema_name, table_name, change_ratio * 100, ttl)
+        sqlite_util.set_table_meta(self.db, schema_name, table_name, ttl=ttl, change_ratio=change_ratio)
+
+    def get_configured_ttl(self, table_name):
+        """
+        Cache ttl of given table from the first matching --table-ttls pattern, or the global one.
+        """
+        for pattern, ttl in self.table_ttls:
+            if fnmatch.fnmatchcase(table_name, pattern):
+                return ttl
+        return self.table_cache_ttl
+
+    def get_table_ttl(self, table_name, meta):
+        if self.adaptive_ttl and meta['ttl'] is not None:
+            return meta['ttl']
+        return self.get_configured_ttl(table_name)
+
+    def is_fresh_enough(self, schema_name, table_name, limit=None, fetch_filter=None):
+        """
+        Check if the cached table is recent enough and has enough rows, i.e. it's either a full table or
+        a partial one with at least `limit` rows or with the rows matching `fetch_filter`, to be used without
+        fetching it again.
+        """
+        # refresh time is kept in the region database so cached tables can be reused across aq runs
+        meta = sqlite_util.get_table_meta(self.db, schema_name, table_name)
+        if not is_cached(meta, limit, fetch_filter):
+            return False
+        age = time.time() - meta['refreshed_at']
+        return age < self.get_table_ttl(table_name, meta)
+
+    def get_table_catalog(self, table, sample_size=CATALOG_SAMPLE_SIZE):
+        """
+        Get the columns of given loaded table and the keys of the JSON objects in a sample of its rows.
+
+        :return: tuple of the columns list and a dict of column name to the set of its JSON object keys
+        """
+        region, table_name = self.resolve_table(table)
+        # the catalog is only read so no database is created for a table that was never loaded
+        views = []
+        if self.has_storage(region, None):
+            views, _ = self.split_materialized_views(QueryMetadata(tables=[table]))
+        if views:
+            schema_name = self.attach_storage(region, None)
+        elif self.has_storage(region, table_name):
+            schema_name = self.attach_storage(region, table_name)
+        else:
+            raise QueryError('Table {0}.{1} is not loaded'.format(region, table.table))
+        try:
+            cursor = self.db.execute('SELECT * FROM {0}.{1} LIMIT ?'.format(schema_name, table.table),
+                                     (sample_size,))
+        except sqlite3.OperationalError as e:
+            raise QueryError(str(e))
+        columns = [d[0] for d in cursor.description]
+        json_keys = defaultdict(set)
+        for row in cursor:
+            for column, value in zip(columns, row):
+                if isinstance(value, string_types) and value.startswith('{'):
+                    try:
+                        obj = json.loads(value)
+                    except ValueError:
+                        continue
+                    if isinstance(obj, dict):
+                        json_keys[column].update(obj)
+        return columns, json_keys
 
     @property
     def available_schemas(self):
@@ -135,6 +865,337 @@ class BotoSqliteEngine(object):
         for attr in dir(resource):
             if isinstance(getattr(resource, attr), CollectionManager):
                 yield '{0}_{1}'.format(resource_name, attr)
+        # collections of the resources of each top-level collection, see ParentScopedCollection
+        for parent_collection in resource.meta.resource_model.collections:
+            parent_model = parent_collection.resource.model
+            for collection in parent_model.collections:
+                yield '{0}_{1}_{2}'.format(resource_name, xform_name(parent_model.name), collection.name)
+
+
+class PerTableBotoSqliteEngine(BotoSqliteEngine):
+    """
+    Engine storing each table in its own database file, ~/.aq/<region>/<table>.db, instead of one
+    database file per region. Different tables can then be refreshed in parallel without contending
+    on the same write lock and a single table can be dropped by simply deleting its file.
+
+    Each table database is attached as `<region>__<table>` schema and queries are rewritten to use it
+    so tables are still referenced as `<region>.<table>` (or just `<table>` for the default region).
+    """
+
+    def __init__(self, options=None):
+        # schema names of the attached databases of each connection, least recently used first
+        self.attached_schemas = defaultdict(OrderedDict)
+        # schema names of the databases the running query needs, which must stay attached until it's executed
+        self.pinned_schemas = None
+        super(PerTableBotoSqliteEngine, self).__init__(options)
+        self.max_attached_databases = sqlite_util.max_attached_databases(self.db)
+
+    def execute_cursor(self, query, metadata):
+        self.pinned_schemas = set()
+        try:
+            return super(PerTableBotoSqliteEngine, self).execute_cursor(query, metadata)
+        finally:
+            self.pinned_schemas = None
+
+    def storage_schema(self, region, table_name):
+        if table_name is None:
+            return region
+        return '{0}__{1}'.format(region, table_name)
+
+    def storage_file_path(self, region, table_name):
+        if table_name is None:
+            return self.region_db_file_path(region)
+        return os.path.join(self.data_dir, region, '{0}.db'.format(table_name))
+
+    def attach_storage(self, region, table_name, read_only=False):
+        db = self.read_only_db if read_only else self.db
+        attached = self.attached_schemas[id(db)]
+        schema_name = self.storage_schema(region, table_name)
+        if schema_name == self.default_region:
+            # the default region database is never detached, one database is left for it below
+            return super(PerTableBotoSqliteEngine, self).attach_storage(region, table_name, read_only)
+        if schema_name in attached:
+            # mark as most recently used
+            del attached[schema_name]
+        elif not self.is_attached_region(schema_name, db):
+            if not read_only:
+                util.ensure_dir_exists(os.path.dirname(self.storage_file_path(region, table_name)))
+            while len(attached) >= self.max_attached_databases - 1:
+                lru_schema_name = next((s for s in attached if not self.is_pinned(s)), None)
+                if lru_schema_name is None:
+                    raise QueryError('Query needs more than the {0} tables that can be attached at once'
+                                     .format(self.max_attached_databases - 1))
+                del attached[lru_schema_name]
+                LOGGER.info('Detaching least recently used database: %s', lru_schema_name)
+                db.execute('DETACH DATABASE {0}'.format(lru_schema_name))
+        attached[schema_name] = True
+        if self.pinned_schemas is not None:
+            self.pinned_schemas.add(schema_name)
+        return super(PerTableBotoSqliteEngine, self).attach_storage(region, table_name, read_only)
+
+    def is_pinned(self, schema_name):
+        return self.pinned_schemas is not None and schema_name in self.pinned_schemas
+
+    def rewrite_query(self, query, meta):
+        """
+        Replace tables references in given query, i.e. `<region> . <table>`, `<region>.<table>.<column>` or
+        just `<table>` for the default region, with the schema storing each table.
+        """
+        for table in meta.tables:
+            region, table_name = self.resolve_table(table)
+            schema_name = self.storage_schema(region, table_name)
+            if table.database:
+                replacements = [
+                    (r'(?<![\w.]){0} \. {1}(?![\w.])'.format(table.database, table.table),
+                     '{0} . {1}'.format(schema_name, table.table)),
+                    (r'(?<![\w.]){0}\.{1}\.'.format(table.database, table.table),
+                     '{0}.{1}.'.format(schema_name, table.table)),
+                ]
+            else:
+                # column references by table name (i.e. `<table>.<column>`) still work without rewriting
+                replacements = [
+                    (r'(?<![\w.])(?<!\. ){0}(?![\w.])'.format(table.table),
+                     '{0} . {1}'.format(schema_name, table.table)),
+                ]
+            for pattern, replacement in replacements:
+                query = replace_outside_string_literals(pattern, replacement, query)
+        return query
+
+
+class InMemoryBotoSqliteEngine(BotoSqliteEngine):
+    """
+    Engine keeping tables in memory only, in one shared-cache in-memory database per region, for short-lived
+    runs where writing tables to disk is pure overhead. Tables are lost when the process exits but are shared
+    by all engines of the process while it runs.
+
+    In-memory databases are never synced to disk and already keep their rollback journal in memory, which is
+    still needed to roll back interrupted table loads, so there is nothing to tune.
+    """
+
+    # a write transaction on a shared-cache database locks its schema for all other connections, readers included
+    supports_background_loading = False
+
+    def init_db(self):
+        # region databases are all attached, even the default region, as a connection cannot attach
+        # the shared-cache database it was opened with. Unqualified table names resolve to the first
+        # attached database having them, i.e. the default region first
+        return sqlite_util.connect('file::memory:', uri=True)
+
+    def region_db_file_path(self, region):
+        name = 'aq_sample_{0}' if self.sample_size else 'aq_{0}'
+        return sqlite_util.memory_uri(name.format(region))
+
+    def is_cached_query(self, meta):
+        # the read-only connection is meant for reading database files without locking them
+        return False
+
+    def has_storage(self, region, table_name):
+        # attaching an in-memory database doesn't create anything
+        return True
+
+
+def parse_table_ttls(value):
+    """
+    Parse the --table-ttls option, e.g. "ec2_instances=60,iam_*=86400".
+
+    :return: list of (table name pattern, ttl in seconds) tuples, in given order
+    """
+    if not value:
+        return []
+    table_ttls = []
+    for item in value.split(','):
+        pattern, _, ttl = item.partition('=')
+        try:
+            table_ttls.append((pattern.strip(), int(ttl)))
+        except ValueError:
+            raise AQError('Invalid table ttl "{0}", must be <table pattern>=<seconds>'.format(item))
+    return table_ttls
+
+
+def get_change_ratio(previous_row_hashes, row_hashes):
+    """
+    Share of the rows that were added, removed or changed between two versions of a table.
+    """
+    all_rows = previous_row_hashes | row_hashes
+    if not all_rows:
+        return 0.0
+    return float(len(previous_row_hashes ^ row_hashes)) / len(all_rows)
+
+
+def merge_table_loads(loads):
+    """
+    Merge the `TableLoad` of a table needed by multiple queries into one load that is enough for all of them:
+    all rows if any of them needs all rows or the most rows any of them needs if they only need first rows.
+
+    :return: the merged load or None if they need different partial tables, e.g. the rows matching different
+             filters, which can only be loaded by each query in turn
+    """
+    if len(set(loads)) == 1:
+        return loads[0]
+    full_table = TableLoad(None, None, ())
+    if full_table in loads:
+        return full_table
+    if any(load.fetch_filter is not None for load in loads):
+        return None
+    return TableLoad(max(load.limit for load in loads), None, ())
+
+
+def is_cached(table_meta, limit=None, fetch_filter=None):
+    """
+    Check if a table, with given metadata, is cached with enough rows for a query needing `limit` rows of it
+    or its rows matching `fetch_filter`, regardless of how old the cache is.
+    """
+    if table_meta is None or table_meta['refreshed_at'] is None:
+        return False
+    if table_meta['fetch_filter'] is not None and table_meta['fetch_filter'] != fetch_filter:
+        return False
+    return table_meta['fetch_limit'] is None or (limit is not None and limit <= table_meta['fetch_limit'])
+
+
+def estimate_fetch_seconds(table_meta, limit=None):
+    """
+    Estimate the time to fetch a table, or only its first `limit` rows, from its last full fetch.
+
+    :return: estimated time in seconds or None if the table was never fully fetched
+    """
+    if table_meta is None or table_meta['fetch_seconds'] is None:
+        return None
+    if limit is not None and table_meta['row_count']:
+        return table_meta['fetch_seconds'] * min(1.0, float(limit) / table_meta['row_count'])
+    return table_meta['fetch_seconds']
+
+
+def find_parent_collection(resource, collection_name):
+    """
+    Find the top-level collection of given resource whose resources have given sub-collection, where
+    collection name is the name of the resources of the top-level collection followed by the name of the
+    sub-collection, e.g. `bucket_objects` for the `objects` of each resource of the `buckets` collection.
+
+    :return: name of the top-level collection or None if not found
+    """
+    for parent_collection in resource.meta.resource_model.collections:
+        parent_model = parent_collection.resource.model
+        prefix = '{0}_'.format(xform_name(parent_model.name))
+        if collection_name.startswith(prefix):
+            if collection_name[len(prefix):] in (c.name for c in parent_model.collections):
+                return parent_collection.name
+    return None
+
+
+class ParentScopedCollection(object):
+    """
+    Collection of the sub-resources of all resources of a top-level collection, e.g. the objects of all S3
+    buckets, listed concurrently for each of them (parent). Sub-resources get the identifiers of their parent
+    as columns prefixed by the parent name, e.g. `bucket_name`, if they don't have them already.
+
+    Only the parents matching the query predicates on their identifier are listed, and some predicates on the
+    sub-resources are pushed down to their listing, e.g. the prefix of S3 object keys.
+
+    This implements the part of the boto3 collections API used by `BotoSqliteEngine.fetch_table`.
+    """
+
+    def __init__(self, resource, parent_collection_name, collection_name):
+        self.resource = resource
+        self.parent_collection_name = parent_collection_name
+        self.parent_model = [c.resource.model for c in resource.meta.resource_model.collections
+                             if c.name == parent_collection_name][0]
+        parent_name = xform_name(self.parent_model.name)
+        # e.g. objects for bucket_objects
+        self.collection_name = collection_name[len(parent_name) + 1:]
+        # model of the sub-collection, for its columns list
+        self._model = [c for c in self.parent_model.collections if c.name == self.collection_name][0]
+        # column name of each parent identifier, e.g. bucket_name for the name of a bucket
+        self.parent_identifiers = OrderedDict(('{0}_{1}'.format(parent_name, i.name), i.name)
+                                              for i in self.parent_model.identifiers)
+        # identifiers of the parents to list, None to list all parents
+        self.parent_ids = None
+        # filters of the listing of each parent's sub-resources
+        self.filters = {}
+        # everything that was pushed down, by column or filter name
+        self.pushed_down_filter = {}
+        self._limit = None
+
+    @property
+    def parent_columns(self):
+        return list(self.parent_identifiers)
+
+    def push_down(self, predicates):
+        for predicate in predicates:
+            if predicate.column in self.parent_identifiers and len(self.parent_identifiers) == 1 \
+                    and predicate.operator in ('=', 'IN'):
+                # only the given parents, which can be created from their identifier without listing them
+                parent_ids = set(predicate.values)
+                self.parent_ids = parent_ids if self.parent_ids is None else self.parent_ids & parent_ids
+                self.pushed_down_filter[predicate.column] = sorted(self.parent_ids)
+                continue
+            filter_name = SUB_COLLECTION_FILTERS.get(
+                (self.resource.meta.service_name, self.collection_name, predicate.column))
+            prefix = get_prefix(predicate)
+            if filter_name and prefix:
+                self.filters[filter_name] = prefix
+                self.pushed_down_filter[filter_name] = prefix
+
+    def all(self):
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def pages(self):
+        parents = self.get_parents()
+        if not parents:
+            return
+        pool = Pool(processes=min(len(parents), MAX_FETCH_WORKERS))
+        try:
+            remaining = self._limit
+            for page in pool.imap_unordered(self.list_parent, parents):
+                if remaining is not None:
+                    page = page[:remaining]
+                    remaining -= len(page)
+                yield page
+                if remaining == 0:
+                    break
+        finally:
+            # don't list the parents that are not listed yet if we stop before the end
+            pool.terminate()
+
+    def get_parents(self):
+        if self.parent_ids is not None:
+            parent_type = getattr(self.resource, self.parent_model.name)
+            return [parent_type(parent_id) for parent_id in sorted(self.parent_ids)]
+        return list(getattr(self.resource, self.parent_collection_name).all())
+
+    def list_parent(self, parent):
+        """
+        List all sub-resources of given parent.
+        """
+        items = getattr(parent, self.collection_name).all()
+        if self.filters:
+            items = items.filter(**self.filters)
+        if self._limit is not None:
+            items = items.limit(self._limit)
+        parent_ids = dict((column, getattr(parent, identifier))
+                          for column, identifier in self.parent_identifiers.items())
+        return [ObjectProxy(item, **parent_ids) for item in items]
+
+
+def get_prefix(predicate):
+    """
+    Get the prefix of the values matching given predicate, if it's about a single prefix.
+    """
+    if predicate.operator == '=' and len(predicate.values) == 1:
+        return predicate.values[0]
+    if predicate.operator == 'GLOB':
+        prefix = re.split(r'[*?\[]', predicate.values[0])[0]
+    elif predicate.operator == 'LIKE':
+        prefix = re.split(r'[%_]', predicate.values[0])[0]
+        if prefix.lower() != prefix.upper():
+            # LIKE is case-insensitive for ASCII letters but AWS prefixes are not
+            return None
+    else:
+        return None
+    return prefix or None
 
 
 class ObjectProxy(object):
@@ -167,6 +1228,45 @@ def convert_tags_to_dict(item):
     return item
 
 
+def get_dependencies_metadata(view):
+    """
+    Metadata of a query on all rows of the tables given materialized view is computed from.
+    """
+    return QueryMetadata(tables=[TableId(region, table_name, None) for region, table_name in view['dependencies']])
+
+
+def qualify_table_names(query, tables, region):
+    """
+    Qualify the references to given tables of the default region in given query, i.e. just `<table>`,
+    with given region.
+    """
+    for table in tables:
+        if not table.database:
+            query = replace_outside_string_literals(r'(?<![\w.])(?<!\. ){0}(?![\w.])'.format(table.table),
+                                                    '{0} . {1}'.format(region, table.table), query)
+    return query
+
+
+def replace_outside_string_literals(pattern, replacement, query):
+    parts = re.split(r"('(?:[^']|'')*')", query)
+    # odd parts are the string literals
+    return ''.join(part if i % 2 else re.sub(pattern, replacement, part) for i, part in enumerate(parts))
+
+
+def serialize_resource(resource):
+    """
+    Serialize a resource referenced by another one by its identifiers only as getting any other
+    attribute could trigger a load of the resource from AWS.
+    """
+    identifiers = resource.meta.identifiers
+    if len(identifiers) == 1:
+        return getattr(resource, identifiers[0])
+    return dict((name, getattr(resource, name)) for name in identifiers)
+
+
+sqlite_util.register_serializer(ServiceResource, serialize_resource)
+
+
 def get_resource_model_attributes(resource, collection):
     service_model = resource.meta.client.meta.service_model
     resource_model = get_resource_model(collection)
@@ -185,7 +1285,10 @@ def get_columns_list(resource, collection):
     attributes = get_resource_model_attributes(resource, collection)
     LOGGER.debug('Model attributes: %s', pprint.pformat(attributes))
 
-    return list(itertools.chain(identifiers, attributes))
+    columns = list(itertools.chain(identifiers, attributes))
+    if isinstance(collection, ParentScopedCollection):
+        columns = [c for c in collection.parent_columns if c not in columns] + columns
+    return columns
 
 
 def get_resource_model(collection):
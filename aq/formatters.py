@@ -1,10 +1,59 @@
+import itertools
+import numbers
+
 from tabulate import tabulate
 
+# number of rows of each chunk of a result formatted chunk by chunk
+CHUNK_SIZE = 1000
+
 
 class TableFormatter(object):
     def __init__(self, options=None):
         self.options = options if options else {}
 
-    @staticmethod
-    def format(columns, rows):
-        return tabulate(rows, headers=columns, tablefmt='psql', missingval='NULL')
+    def format(self, columns, rows):
+        return tabulate(rows, headers=columns, tablefmt='psql', missingval='NULL') + self.format_footer()
+
+    def format_chunks(self, columns, sample_rows, rows, chunk_size=CHUNK_SIZE):
+        """
+        Format a result in the same table format as `format` but chunk by chunk, so a large result can be shown
+        before all of its rows are fetched.
+
+        Columns are sized (and aligned) from the sample rows only, i.e. the first rows of the result,
+        a later value longer than its column width just overflows.
+
+        :param sample_rows: list of the first rows of the result
+        :param rows: iterator over the rest of the rows of the result
+        :return: iterator over the formatted chunks
+        """
+        sample_values = [[format_value(v) for v in row] for row in sample_rows]
+        widths = [max([len(column)] + [len(row[i]) for row in sample_values]) for i, column in enumerate(columns)]
+        # numbers are right aligned, as long as all sampled values of the column are numbers
+        right_aligned = [all(row[i] is None or isinstance(row[i], numbers.Number) for row in sample_rows)
+                         for i in range(len(columns))]
+        border = '+{0}+\n'.format('+'.join('-' * (w + 2) for w in widths))
+
+        yield border + format_line(columns, widths, right_aligned) + \
+            '|{0}|\n'.format('+'.join('-' * (w + 2) for w in widths))
+        all_rows = itertools.chain(sample_rows, rows)
+        while True:
+            chunk = list(itertools.islice(all_rows, chunk_size))
+            if not chunk:
+                break
+            yield ''.join(format_line([format_value(v) for v in row], widths, right_aligned) for row in chunk)
+        yield border.rstrip('\n') + self.format_footer() + '\n'
+
+    def format_footer(self):
+        if self.options.get('--sample'):
+            return '\nApproximate result, computed from a sample of the first {0} rows of each table'.format(
+                self.options['--sample'])
+        return ''
+
+
+def format_value(value):
+    return 'NULL' if value is None else u'{0}'.format(value)
+
+
+def format_line(values, widths, right_aligned):
+    cells = (v.rjust(w) if right else v.ljust(w) for v, w, right in zip(values, widths, right_aligned))
+    return '| {0} |\n'.format(' | '.join(cells))
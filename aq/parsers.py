@@ -1,13 +1,35 @@
 import collections
+import re
 from collections import namedtuple
 
 from six import string_types
 
 from aq.errors import QueryParsingError
-from aq.select_parser import select_stmt, ParseException
+from aq.select_parser import statement, ParseException
 
 TableId = namedtuple('TableId', ('database', 'table', 'alias'))
-QueryMetadata = namedtuple('QueryMetadata', ('tables',))
+QueryMetadata = namedtuple('QueryMetadata', ('tables', 'limit', 'predicates', 'materialized_view'))
+# limit: number of rows of its only table that are enough to answer the query, None if all rows are needed
+# predicates: conditions that all result rows of its only table match, see `get_predicates`
+# materialized_view: `MaterializedView` to create from the query result, None for a plain query
+QueryMetadata.__new__.__defaults__ = (None, (), None)
+# view created by `CREATE MATERIALIZED VIEW [<database>.]<name> [INDEX ON (<columns>)] AS <select>`
+MaterializedView = namedtuple('MaterializedView', ('database', 'name', 'index_columns'))
+# condition on a column with string values, e.g. Predicate('bucket_name', 'IN', ('foo', 'bar'))
+Predicate = namedtuple('Predicate', ('column', 'operator', 'values'))
+
+# keywords of the queries that need all rows of their tables regardless of their LIMIT
+NON_LIMITABLE_KEYWORDS = {'WHERE', 'GROUP', 'HAVING', 'ORDER', 'DISTINCT', 'JOIN', 'UNION', 'INTERSECT', 'EXCEPT'}
+AGGREGATE_FUNCTION = re.compile(r'\b(avg|count|group_concat|max|min|sum|total)\s*\(', re.IGNORECASE)
+
+# operators of the conditions that can be predicates, `==` is the same as `=`
+PREDICATE_OPERATORS = {'=': '=', '==': '=', 'IN': 'IN', 'LIKE': 'LIKE', 'GLOB': 'GLOB'}
+# column, optionally qualified by its table (and database), e.g. `o.bucket_name`
+COLUMN_REFERENCE = re.compile(r'^(?:(?:(?P<database>\w+)\.)?(?P<table>\w+)\.)?(?P<column>\w+)$')
+STRING_LITERAL = re.compile(r"'((?:[^']|'')*)'")
+
+# string literal, comment, statements separator or anything else
+STATEMENT_TOKEN = re.compile(r"'(?:[^']|'')*'?|--[^\n]*|;|[^';-]+|-")
 
 
 class SelectParser(object):
@@ -17,13 +39,145 @@ class SelectParser(object):
     @staticmethod
     def parse_query(query):
         try:
-            parse_result = select_stmt.parseString(query, parseAll=True)
+            parse_result = statement.parseString(query, parseAll=True)
         except ParseException as e:
             raise QueryParsingError(e)
 
+        if parse_result.view_name:
+            # the view is computed from all rows of its tables, whatever its query limit or predicates
+            parsed_query, metadata = SelectParser.parse_select(parse_result.select)
+            view = MaterializedView(parse_result.view_database[0] if parse_result.view_database else None,
+                                    parse_result.view_name[0], tuple(parse_result.index_columns))
+            return parsed_query, QueryMetadata(tables=metadata.tables, materialized_view=view)
+        return SelectParser.parse_select(parse_result)
+
+    @staticmethod
+    def parse_select(parse_result):
         tables = [parse_table_id(tid) for tid in parse_result.table_ids]
-        parsed_query = concat(parse_result)
-        return parsed_query, QueryMetadata(tables=tables)
+        tokens = list(flatten(parse_result))
+        parsed_query = ' '.join(tokens)
+        return parsed_query, QueryMetadata(tables=tables, limit=get_fetch_limit(tokens, tables),
+                                           predicates=get_predicates(parse_result.asList(), tokens, tables))
+
+
+def split_statements(text):
+    """
+    Split given text into its `;` separated SQL statements, skipping `--` comments and empty statements.
+    """
+    statements = []
+    current = []
+    for token in STATEMENT_TOKEN.findall(text):
+        if token == ';':
+            statements.append(''.join(current))
+            current = []
+        elif not token.startswith('--'):
+            current.append(token)
+    statements.append(''.join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def get_fetch_limit(tokens, tables):
+    """
+    Get the number of rows of its table that are enough to answer a query with given tokens.
+    That's the query's LIMIT (plus OFFSET) if it selects from a single table without any filter,
+    ordering, aggregation, join or sub query, None otherwise.
+    """
+    if len(tables) != 1 or 'LIMIT' not in tokens or tokens.count('SELECT') != 1:
+        return None
+    if NON_LIMITABLE_KEYWORDS.intersection(tokens):
+        return None
+    if any(AGGREGATE_FUNCTION.search(token) for token in tokens):
+        return None
+
+    # LIMIT <limit> | LIMIT <limit> OFFSET <offset> | LIMIT <offset>, <limit>
+    args = tokens[tokens.index('LIMIT') + 1:]
+    try:
+        numbers = [int(arg) for arg in args if arg not in ('OFFSET', ',')]
+    except ValueError:
+        return None
+    # negative limit means no limit
+    if not numbers or any(n < 0 for n in numbers):
+        return None
+    return sum(numbers)
+
+
+def get_predicates(parsed, tokens, tables):
+    """
+    Get the conditions that all result rows of a query on a single table match, i.e. the conditions of its
+    WHERE clause that are and-ed at the top level and are one of `<column> = <string>`,
+    `<column> IN (<strings>)`, `<column> LIKE <string>` or `<column> GLOB <string>`.
+    Fetching only the rows matching them is then enough to answer the query.
+
+    :param parsed: the nested list of the parsed query, conditions are grouped by operator precedence
+    :return: tuple of `Predicate`
+    """
+    if len(tables) != 1 or tokens.count('SELECT') != 1 or 'WHERE' not in parsed:
+        return ()
+    where_index = parsed.index('WHERE') + 1
+    where = parsed[where_index]
+    if where == '(':
+        # parenthesized expressions are not grouped with their parentheses
+        where = parsed[where_index:where_index + 3]
+    predicates = (parse_predicate(condition, tables[0]) for condition in get_conjuncts(where))
+    return tuple(p for p in predicates if p is not None)
+
+
+def get_conjuncts(expression):
+    """
+    Get the conditions and-ed at the top level of given parsed expression.
+    """
+    if not isinstance(expression, list):
+        return [expression]
+    operands = []
+    operators = []
+    i = 0
+    while i < len(expression):
+        if expression[i] == '(':
+            operands.append(expression[i:i + 3])
+            i += 3
+        else:
+            operands.append(expression[i])
+            i += 1
+        if i < len(expression):
+            operators.append(expression[i])
+            i += 1
+    if not operators and expression[0] == '(':
+        return get_conjuncts(expression[1])
+    if operators and all(operator == 'AND' for operator in operators):
+        return [conjunct for operand in operands for conjunct in get_conjuncts(operand)]
+    return [expression]
+
+
+def parse_predicate(condition, table):
+    """
+    :return: `Predicate` of given condition on a column of given table or None if it's not a predicate
+    """
+    if not isinstance(condition, list) or len(condition) != 3:
+        return None
+    column, operator, value = condition
+    if operator not in PREDICATE_OPERATORS or not isinstance(column, string_types) \
+            or not isinstance(value, string_types):
+        return None
+    column_reference = COLUMN_REFERENCE.match(column)
+    if not column_reference or column_reference.group('table') not in (None, table.table, table.alias):
+        return None
+    values = parse_string_literals(value)
+    if not values or (operator != 'IN' and len(values) != 1):
+        return None
+    return Predicate(column_reference.group('column'), PREDICATE_OPERATORS[operator], values)
+
+
+def parse_string_literals(value):
+    """
+    Parse a string literal, e.g. `'foo'`, or a list of string literals, e.g. `('foo', 'bar')`.
+
+    :return: tuple of the strings or None if given value is anything else
+    """
+    if value.startswith('(') and value.endswith(')'):
+        value = value[1:-1]
+    if re.sub(STRING_LITERAL, '', value).replace(',', '').strip():
+        return None
+    return tuple(v.replace("''", "'") for v in STRING_LITERAL.findall(value))
 
 
 def parse_table_id(table_id):
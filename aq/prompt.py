@@ -1,7 +1,13 @@
 from __future__ import unicode_literals
 
+import bisect
 import itertools
 import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from six.moves.queue import Queue
 
 from prompt_toolkit import AbortAction, CommandLineInterface
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
@@ -13,11 +19,13 @@ from prompt_toolkit.validation import Validator, ValidationError
 from pygments.lexers.sql import SqlLexer
 
 from aq import util
-from aq.errors import QueryParsingError
+from aq.errors import AQError, QueryParsingError
 from aq.logger import get_logger
 
 LOGGER = get_logger()
 
+DEFAULT_PREFETCH_TABLES = 3
+
 
 class AqPrompt(object):
     def __init__(self, parser, engine, options=None):
@@ -25,11 +33,13 @@ class AqPrompt(object):
         self.engine = engine
         self.options = options if options is not None else {}
         util.ensure_data_dir_exists()
+        self.history = FileHistory(os.path.expanduser('~/.aq/history'))
+        self.completer = AqCompleter(schemas=engine.available_schemas, tables=engine.available_tables)
         application = create_prompt_application(
             message='> ',
             lexer=PygmentsLexer(SqlLexer),
-            history=FileHistory(os.path.expanduser('~/.aq/history')),
-            completer=AqCompleter(schemas=engine.available_schemas, tables=engine.available_tables),
+            history=self.history,
+            completer=self.completer,
             auto_suggest=AutoSuggestFromHistory(),
             validator=QueryValidator(parser),
             on_abort=AbortAction.RETRY,
@@ -38,13 +48,104 @@ class AqPrompt(object):
         self.cli = CommandLineInterface(application=application, eventloop=loop)
         self.patch_context = self.cli.patch_stdout_context()
 
+        prefetch_tables = int(self.options.get('--prefetch') or DEFAULT_PREFETCH_TABLES)
+        self.prefetcher = None
+        if prefetch_tables > 0 and engine.supports_background_loading:
+            self.prefetcher = TablePrefetcher(parser, engine, prefetch_tables)
+            self.prefetcher.start(list(self.history))
+
     def prompt(self):
         with self.patch_context:
             return self.cli.run(reset_current_buffer=True).text
 
     def update_with_result(self, query_metadata):
-        # TODO
-        pass
+        for table in query_metadata.tables:
+            try:
+                columns, json_keys = self.engine.get_table_catalog(table)
+            except AQError as e:
+                LOGGER.debug('Failed to get catalog of table %s: %s', table, e)
+            else:
+                self.completer.update_catalog(columns, json_keys)
+        if self.prefetcher:
+            self.prefetcher.record(query_metadata.tables)
+
+
+class TablePrefetcher(object):
+    """
+    Predict the tables that will be queried next and load them in the background while user is typing.
+
+    Predictions are based on how often a table was queried right after the tables of the last query,
+    learnt from the queries history and the tables of each query in this session.
+    """
+
+    def __init__(self, parser, engine, max_tables=DEFAULT_PREFETCH_TABLES):
+        self.parser = parser
+        self.engine = engine
+        self.max_tables = max_tables
+        # transitions[table][next_table] = how many times next_table was queried right after table
+        self.transitions = defaultdict(Counter)
+        self.last_tables = []
+        self.lock = threading.Lock()
+        self.queue = Queue()
+
+    def start(self, history_queries):
+        thread = threading.Thread(target=self.run, args=(history_queries,), name='aq-prefetch')
+        thread.daemon = True
+        thread.start()
+
+    def record(self, tables):
+        with self.lock:
+            tables = [self.table_key(t) for t in tables]
+            self.add_transitions(self.last_tables, tables)
+            self.last_tables = tables
+            predicted = self.predict(tables)
+        self.queue.put(predicted)
+
+    def add_transitions(self, tables, next_tables):
+        for table in tables:
+            for next_table in next_tables:
+                self.transitions[table][next_table] += 1
+
+    def predict(self, tables):
+        scores = Counter()
+        for table in tables:
+            scores.update(self.transitions[table])
+        return [table for table, _ in scores.most_common(self.max_tables)]
+
+    @staticmethod
+    def table_key(table):
+        # alias is irrelevant to which table will be loaded
+        return table._replace(alias=None)
+
+    def run(self, history_queries):
+        # parsing the history can take a while so it's done in the background too
+        last_tables = []
+        for query in history_queries:
+            try:
+                _, metadata = self.parser.parse_query(query)
+            except QueryParsingError:
+                continue
+            tables = [self.table_key(t) for t in metadata.tables]
+            with self.lock:
+                self.add_transitions(last_tables, tables)
+            last_tables = tables
+        with self.lock:
+            if not self.last_tables:
+                # nothing queried in this session yet, user is likely to continue from last session
+                self.queue.put(last_tables + self.predict(last_tables))
+
+        # SQLite connections cannot be shared between threads so we need our own engine
+        engine = type(self.engine)(self.engine.options)
+        while True:
+            tables = self.queue.get()
+            LOGGER.debug('Prefetching tables: %s', tables)
+            for table in tables:
+                try:
+                    engine.load_table(table)
+                except AQError as e:
+                    LOGGER.debug('Failed to prefetch table %s: %s', table, e)
+                except Exception:
+                    LOGGER.debug('Failed to prefetch table %s', table, exc_info=True)
 
 
 class AqCompleter(Completer):
@@ -52,7 +153,8 @@ class AqCompleter(Completer):
         NATURAL, INNER, CROSS, LEFT, OUTER, JOIN, AS, INDEXED, NOT, SELECT, DISTINCT,
         FROM, WHERE, GROUP, BY, HAVING, ORDER, BY, LIMIT, OFFSET CAST, ISNULL, NOTNULL,
         NULL, IS, BETWEEN, ELSE, END, CASE, WHEN, THEN, EXISTS, COLLATE, IN, LIKE, GLOB,
-        REGEXP, MATCH, ESCAPE, CURRENT_TIME, CURRENT_DATE, CURRENT_TIMESTAMP
+        REGEXP, MATCH, ESCAPE, CURRENT_TIME, CURRENT_DATE, CURRENT_TIMESTAMP, CREATE, MATERIALIZED,
+        VIEW, INDEX
         '''.replace(',', '').split()
 
     functions = '''avg, count, max, min, sum, json_get'''.replace(',', '').split()
@@ -60,13 +162,35 @@ class AqCompleter(Completer):
     starters = ['SELECT']
 
     def __init__(self, schemas=None, tables=None):
+        # tables list is only materialized on first use for faster startup time
         self.schemas = schemas if schemas else []
         self.tables = tables if tables else []
-        self.tables_and_schemas = itertools.chain(self.schemas, self.tables)
-        self.all_completions = itertools.chain(self.keywords, self.functions,
-                                               self.tables_and_schemas)
+        self.tables_index = None
+        self.keywords_index = PrefixIndex(itertools.chain(self.keywords, self.functions))
+        self.columns_index = PrefixIndex()
+        # json_keys_index[column] = index of the keys of JSON objects seen in that column
+        self.json_keys_index = defaultdict(PrefixIndex)
+
+    def update_catalog(self, columns, json_keys):
+        """
+        Add columns and keys of JSON object columns of a loaded table to the completion candidates.
+
+        :param json_keys: dict of column name to the JSON object keys seen in that column
+        """
+        self.columns_index.update(columns)
+        for column, keys in json_keys.items():
+            self.json_keys_index[column.lower()].update(keys)
 
     def get_completions(self, document, complete_event):
+        json_key_access = JSON_KEY_ACCESS.search(document.text_before_cursor)
+        if json_key_access:
+            column, partial_key = json_key_access.group('column', 'key')
+            keys = self.json_keys_index.get(column.lower())
+            if keys:
+                for key in keys.starting_with(partial_key.lstrip("'")):
+                    yield Completion("'{0}'".format(key), -len(partial_key))
+                return
+
         start_of_current_word = document.find_start_of_previous_word(1)
         current_word = document.text_before_cursor[start_of_current_word:].strip().lower()
 
@@ -74,31 +198,60 @@ class AqCompleter(Completer):
         previous_word = document.text_before_cursor[
                         start_of_previous_2_words:start_of_current_word].strip().lower()
 
-        if document.text_before_cursor[-1:].isspace():
+        if document.text_before_cursor[-1:].isspace() or current_word == ',':
             previous_word = current_word
             current_word = ''
 
-        candidates = self.get_completion_candidates(current_word, previous_word, document)
-        for candidate in candidates:
-            if candidate.lower().startswith(current_word):
+        for index in self.get_completion_indexes(previous_word):
+            for candidate in index.starting_with(current_word):
                 yield Completion(candidate, -len(current_word))
 
-    def get_completion_candidates(self, current_word, previous_word, document):
+    def get_completion_indexes(self, previous_word):
         if not previous_word:
-            return self.starters
-
-        if current_word == ',' or previous_word in [',', 'from', 'join']:
-            # we delay the materialize of table list until here for faster startup time
-            if not isinstance(self.tables_and_schemas, list):
-                self.tables_and_schemas = list(self.tables_and_schemas)
-            return self.tables_and_schemas
-
-        if not isinstance(self.all_completions, list):
-            # ensure we materialized the table list first
-            if not isinstance(self.tables_and_schemas, list):
-                self.tables_and_schemas = list(self.tables_and_schemas)
-            self.all_completions = list(self.all_completions)
-        return self.all_completions
+            return [PrefixIndex(self.starters)]
+
+        if self.tables_index is None:
+            self.tables_index = PrefixIndex(itertools.chain(self.schemas, self.tables))
+
+        if previous_word in [',', 'from', 'join']:
+            return [self.tables_index]
+
+        return [self.columns_index, self.keywords_index, self.tables_index]
+
+
+# `column -> 'partial key` at the end of the input
+JSON_KEY_ACCESS = re.compile(r"(?P<column>\w+)\s*->\s*(?P<key>'?\w*)$")
+
+
+class PrefixIndex(object):
+    """
+    Case-insensitive sorted index of words to find all words starting with a prefix with binary search.
+    """
+
+    def __init__(self, words=()):
+        self.words = set()
+        # sorted lower case keys and their words, always replaced together as completions can be
+        # computed in another thread
+        self.entries = ([], [])
+        self.update(words)
+
+    def update(self, words):
+        new_words = set(words) - self.words
+        if new_words:
+            self.words.update(new_words)
+            entries = sorted((w.lower(), w) for w in self.words)
+            self.entries = ([key for key, _ in entries], [word for _, word in entries])
+
+    def starting_with(self, prefix):
+        keys, words = self.entries
+        prefix = prefix.lower()
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            yield words[i]
+            i += 1
+
+    def __len__(self):
+        return len(self.words)
 
 
 class QueryValidator(Validator):
@@ -85,6 +85,8 @@ expr_term = (
     EXISTS + LPAR + select_stmt + RPAR |
     function_name + LPAR + Optional(no_suppress_delimited_list(expr) | "*") + RPAR |
     literal_value |
+    # list of values, e.g. of IN operator
+    LPAR + no_suppress_delimited_list(literal_value) + RPAR |
     bind_parameter |
     (database_name + "." + table_name + "." + identifier) |
     (table_name + "." + identifier) |
@@ -111,7 +113,9 @@ expr << operatorPrecedence(expr_term,
                                (AND, BINARY, opAssoc.LEFT),
                                (OR, BINARY, opAssoc.LEFT),
                                ((BETWEEN, AND), TERNARY, opAssoc.LEFT),
-                           ])
+                           ],
+                           # keep the parentheses, they can change the meaning of the query
+                           lpar=Literal('('), rpar=Literal(')'))
 
 compound_operator = (UNION + Optional(ALL) | INTERSECT | EXCEPT)
 
@@ -147,4 +151,15 @@ select_core = (
 select_stmt << (select_core + ZeroOrMore(compound_operator + select_core) +
                 Optional(ORDER + BY + Group(no_suppress_delimited_list(ordering_term))) +
                 Optional(
-                    LIMIT + (integer | integer + OFFSET + integer | integer + COMMA + integer)))
+                    LIMIT + (integer + OFFSET + integer | integer + COMMA + integer | integer)))
+
+(CREATE, MATERIALIZED, VIEW, INDEX) = map(CaselessKeyword, "CREATE MATERIALIZED VIEW INDEX".split())
+
+# not a SQLite statement, the result of the select statement is stored as a table kept up to date with its tables
+create_materialized_view_stmt = (
+    CREATE + MATERIALIZED + VIEW +
+    (database_name("view_database") + "." + table_name("view_name") | table_name("view_name")) +
+    Optional(INDEX + ON + LPAR + Group(delimitedList(column_name))("index_columns") + RPAR) +
+    AS + Group(select_stmt)("select"))
+
+statement = create_materialized_view_stmt | select_stmt
@@ -1,38 +1,157 @@
+import hashlib
 import json
 import sqlite3
-from datetime import datetime
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
 
 from six import string_types
+from six.moves.urllib.request import pathname2url
 
+# name of the table keeping track of the loaded tables in each schema
+TABLE_META = 'aq_tables'
+TABLE_META_COLUMNS = ('table_name', 'refreshed_at', 'fetch_limit', 'row_count', 'fetch_seconds', 'ttl',
+                      'change_ratio', 'fetch_filter')
+# name of the table keeping track of the materialized views in each schema
+MATERIALIZED_VIEWS = 'aq_materialized_views'
+# SQLite default of the max number of databases attached to a connection
+DEFAULT_MAX_ATTACHED = 10
 
-def connect(path):
+
+def connect(path, uri=False):
+    sqlite3.register_adapter(dict, jsonify)
+    sqlite3.register_adapter(list, jsonify)
+    db = sqlite3.connect(path, uri=uri)
+    db.create_function('json_get', 2, json_get)
+    return db
+
+
+def connect_readonly(path, mmap_size=0, cache_size=None):
+    """
+    Open a read-only connection to the database file at given path.
+    Read-only connections do not take any write lock so many of them, across processes, can read the
+    same database at the same time. With a non-zero mmap_size, pages are read directly from the
+    memory-mapped file instead of being copied into the page cache.
+
+    :param cache_size: page cache size in KiB
+    """
     sqlite3.register_adapter(dict, jsonify)
     sqlite3.register_adapter(list, jsonify)
-    db = sqlite3.connect(path)
+    db = sqlite3.connect(readonly_uri(path), uri=True)
     db.create_function('json_get', 2, json_get)
+    db.execute('PRAGMA query_only = 1')
+    tune_readonly(db, None, mmap_size, cache_size)
     return db
 
 
+def max_attached_databases(db):
+    """
+    Max number of databases that can be attached to given connection, which depends on how SQLite was built.
+    """
+    if hasattr(db, 'getlimit'):
+        return db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    for (option,) in db.execute('PRAGMA compile_options'):
+        if option.startswith('MAX_ATTACHED='):
+            return int(option.split('=', 1)[1])
+    return DEFAULT_MAX_ATTACHED
+
+
+def readonly_uri(path):
+    return 'file:{0}?mode=ro'.format(pathname2url(path))
+
+
+def memory_uri(name):
+    """
+    URI of the in-memory database of given name, shared by all the connections of the process opening it.
+    """
+    return 'file:{0}?mode=memory&cache=shared'.format(name)
+
+
+def tune_readonly(db, schema_name, mmap_size=0, cache_size=None):
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    db.execute('PRAGMA {0}mmap_size = {1:d}'.format(prefix, mmap_size))
+    if cache_size:
+        # negative cache size is in KiB instead of number of pages
+        db.execute('PRAGMA {0}cache_size = {1:d}'.format(prefix, -cache_size))
+
+
+@contextmanager
+def transaction(db):
+    """
+    Run the statements of the block in a single transaction, committed at the end of the block or rolled
+    back on any error (including KeyboardInterrupt).
+    Unlike `with db:`, this also covers DDL statements (e.g. DROP TABLE) which the sqlite3 module would
+    otherwise run in autocommit mode.
+    """
+    db.execute('BEGIN')
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
+
 def jsonify(obj):
-    return json.dumps(obj, default=json_serialize)
+    return JSON_ENCODER.encode(obj)
+
+
+def register_serializer(obj_type, serializer):
+    """
+    Register the function to convert objects of given type (and its sub types) to JSON serializable values.
+    """
+    SERIALIZERS[obj_type] = serializer
+    SERIALIZERS_CACHE.clear()
+
+
+def get_serializer(obj_type):
+    try:
+        return SERIALIZERS_CACHE[obj_type]
+    except KeyError:
+        serializer = next((SERIALIZERS[t] for t in obj_type.__mro__ if t in SERIALIZERS), None)
+        SERIALIZERS_CACHE[obj_type] = serializer
+        return serializer
 
 
 def json_serialize(obj):
     """
     Simple generic JSON serializer for common objects.
+    Objects are serialized by the serializer registered for their type, looked up once per type.
     """
-    if isinstance(obj, datetime):
-        return obj.isoformat()
+    serializer = get_serializer(type(obj))
+    if serializer is not None:
+        return serializer(obj)
 
+    # fallback for unknown types
     if hasattr(obj, 'id'):
-        return jsonify(obj.id)
+        return obj.id
 
     if hasattr(obj, 'name'):
-        return jsonify(obj.name)
+        return obj.name
 
     raise TypeError('{0} is not JSON serializable'.format(obj))
 
 
+def serialize_row(values):
+    """
+    Serialize the structured values (dict and list) of a row to JSON, ready to be inserted.
+    """
+    return [jsonify(v) if type(v) in STRUCTURED_TYPES else v for v in values]
+
+
+# serializer by type for the objects that are not JSON serializable by default
+SERIALIZERS = {
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+# serializer (or None) by the actual type of the serialized objects, resolved from SERIALIZERS
+SERIALIZERS_CACHE = {}
+# a single encoder to not create a new one for every value
+JSON_ENCODER = json.JSONEncoder(default=json_serialize)
+STRUCTURED_TYPES = {dict, list}
+
+
 def json_get(serialized_object, field):
     """
     This emulates the HSTORE `->` get value operation.
@@ -66,11 +185,67 @@ def create_table(db, schema_name, table_name, columns):
     Create a table, schema_name.table_name, in given database with given list of column names.
     """
     table = '{0}.{1}'.format(schema_name, table_name) if schema_name else table_name
-    db.execute('DROP TABLE IF EXISTS {0}'.format(table))
+    drop_table(db, schema_name, table_name)
     columns_list = ', '.join(columns)
     db.execute('CREATE TABLE {0} ({1})'.format(table, columns_list))
 
 
+def drop_table(db, schema_name, table_name):
+    """
+    Drop schema_name.table_name if exists, whether it's a plain table or an interned one.
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    row = db.execute('SELECT type FROM {0}sqlite_master WHERE name = ?'.format(prefix), (table_name,)).fetchone()
+    if row and row[0] in ('table', 'view'):
+        db.execute('DROP {0} {1}{2}'.format(row[0].upper(), prefix, table_name))
+    db.execute('DROP TABLE IF EXISTS {0}{1}_data'.format(prefix, table_name))
+    db.execute('DROP TABLE IF EXISTS {0}{1}_values'.format(prefix, table_name))
+
+
+def create_interned_table(db, schema_name, table_name, columns, items):
+    """
+    Create schema_name.table_name with given items where repeated structured (JSON) values are stored once.
+
+    The structured values are stored in `<table>_values` and replaced by their id in `<table>_data`.
+    `<table>` is then a view over these two tables so it can be queried as a plain table.
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    rows = [[getattr(item, col) for col in columns] for item in items]
+    interned = [any(type(row[i]) in STRUCTURED_TYPES for row in rows) for i in range(len(columns))]
+
+    value_ids = {}
+
+    def intern(value):
+        if value is None:
+            return None
+        value = jsonify(value) if type(value) in STRUCTURED_TYPES else value
+        value_id = value_ids.get(value)
+        if value_id is None:
+            value_id = value_ids[value] = len(value_ids) + 1
+        return value_id
+
+    data_rows = [[intern(v) if interned[i] else v for i, v in enumerate(row)] for row in rows]
+
+    drop_table(db, schema_name, table_name)
+    db.execute('CREATE TABLE {0}{1}_values (id INTEGER PRIMARY KEY, value)'.format(prefix, table_name))
+    db.execute('CREATE TABLE {0}{1}_data ({2})'.format(prefix, table_name, ', '.join(columns)))
+    select_list = []
+    joins = []
+    for i, column in enumerate(columns):
+        if interned[i]:
+            select_list.append('v{0}.value AS {1}'.format(i, column))
+            joins.append('LEFT JOIN {0}_values v{1} ON v{1}.id = d.{2}'.format(table_name, i, column))
+        else:
+            select_list.append('d.{0}'.format(column))
+    db.execute('CREATE VIEW {0}{1} AS SELECT {2} FROM {1}_data d {3}'.format(
+        prefix, table_name, ', '.join(select_list), ' '.join(joins)))
+
+    db.executemany('INSERT INTO {0}{1}_values (id, value) VALUES (?, ?)'.format(prefix, table_name),
+                   ((value_id, value) for value, value_id in value_ids.items()))
+    db.executemany('INSERT INTO {0}{1}_data ({2}) VALUES ({3})'.format(
+        prefix, table_name, ', '.join(columns), ', '.join(['?'] * len(columns))), data_rows)
+
+
 def insert_all(db, schema_name, table_name, columns, items):
     """
     Insert all item in given items list into the specified table, schema_name.table_name.
@@ -80,6 +255,178 @@ def insert_all(db, schema_name, table_name, columns, items):
     values_list = ', '.join(['?'] * len(columns))
     query = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
         table=table, columns=columns_list, values=values_list)
+    db.executemany(query, (serialize_row([getattr(item, col) for col in columns]) for item in items))
+
+
+def row_hash(values):
+    """
+    Content hash of a row's values, used to store identical rows only once across snapshots.
+    """
+    return hashlib.sha1(jsonify(values).encode('utf-8')).hexdigest()
+
+
+def table_row_hashes(db, schema_name, table_name, columns):
+    """
+    Set of the hashes of the rows of schema_name.table_name, to find how much a table changed.
+
+    :return: the set of hashes or None if there is no such table (or it has different columns)
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    try:
+        cursor = db.execute('SELECT {0} FROM {1}{2}'.format(', '.join(columns), prefix, table_name))
+    except sqlite3.OperationalError:
+        return None
+    return set(row_hash(list(row)) for row in cursor)
+
+
+def create_snapshot_tables(db, schema_name, table_name, columns):
+    """
+    Create (if not exists) the tables backing the snapshot history of schema_name.table_name:
+
+    - `aq_snapshots` records each snapshot taken (id, table name and time in epoch seconds)
+    - `<table>_versions` stores each distinct row version once, keyed by its content hash
+    - `<table>_snapshot_rows` maps each snapshot to the row versions it contains
+    - `<table>_history` is a view of all rows of all snapshots, i.e. the table `AS OF` a
+      snapshot is `SELECT * FROM <table>_history WHERE aq_snapshot_id = ?`
+
+    The extra columns are prefixed with `aq_` so they don't clash with the resources' own attributes,
+    e.g. the `snapshot_id` of `ec2_snapshots`.
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    versions = '{0}_versions'.format(table_name)
+    snapshot_rows = '{0}_snapshot_rows'.format(table_name)
+
+    db.execute('CREATE TABLE IF NOT EXISTS {0}aq_snapshots ('
+               'snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT, table_name, taken_at)'.format(prefix))
+    db.execute('CREATE TABLE IF NOT EXISTS {0}{1} (aq_row_hash PRIMARY KEY)'.format(prefix, versions))
+    # resource models can gain new attributes over time so versions table may need more columns
+    existing_columns = set(c[1] for c in db.execute(
+        'PRAGMA {0}table_info({1})'.format(prefix, versions)))
+    for column in columns:
+        if column not in existing_columns:
+            db.execute('ALTER TABLE {0}{1} ADD COLUMN {2}'.format(prefix, versions, column))
+
+    db.execute('CREATE TABLE IF NOT EXISTS {0}{1} ('
+               'aq_snapshot_id, aq_row_hash, PRIMARY KEY (aq_snapshot_id, aq_row_hash))'.format(prefix, snapshot_rows))
+    db.execute('CREATE INDEX IF NOT EXISTS {0}{1}_row_hash ON {1} (aq_row_hash)'.format(prefix, snapshot_rows))
+
+    db.execute('DROP VIEW IF EXISTS {0}{1}_history'.format(prefix, table_name))
+    db.execute('CREATE VIEW {0}{1}_history AS '
+               'SELECT s.snapshot_id AS aq_snapshot_id, s.taken_at AS aq_taken_at, v.* '
+               'FROM aq_snapshots s '
+               'JOIN {2} r ON r.aq_snapshot_id = s.snapshot_id '
+               'JOIN {3} v ON v.aq_row_hash = r.aq_row_hash'.format(prefix, table_name, snapshot_rows, versions))
+
+
+def insert_snapshot(db, schema_name, table_name, columns, items):
+    """
+    Record a new snapshot of given items for schema_name.table_name.
+    Only row versions that have not been seen in any previous snapshot are stored.
+
+    :return: id of the new snapshot
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    cursor = db.execute('INSERT INTO {0}aq_snapshots (table_name, taken_at) VALUES (?, ?)'.format(prefix),
+                        (table_name, time.time()))
+    snapshot_id = cursor.lastrowid
+
+    columns_list = ', '.join(columns)
+    values_list = ', '.join(['?'] * len(columns))
+    insert_version = 'INSERT OR IGNORE INTO {0}{1}_versions (aq_row_hash, {2}) VALUES (?, {3})'.format(
+        prefix, table_name, columns_list, values_list)
+    insert_snapshot_row = 'INSERT OR IGNORE INTO {0}{1}_snapshot_rows (aq_snapshot_id, aq_row_hash) VALUES (?, ?)'.format(
+        prefix, table_name)
+    versions = []
     for item in items:
-        values = [getattr(item, col) for col in columns]
-        db.execute(query, values)
+        values = serialize_row([getattr(item, col) for col in columns])
+        versions.append([row_hash(values)] + values)
+    db.executemany(insert_version, versions)
+    db.executemany(insert_snapshot_row, ((snapshot_id, version[0]) for version in versions))
+    return snapshot_id
+
+
+def ensure_table_meta(db, schema_name):
+    """
+    Create (if not exists) the table keeping track of the loaded tables in given schema.
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    db.execute('CREATE TABLE IF NOT EXISTS {0}{1} (table_name PRIMARY KEY)'.format(prefix, TABLE_META))
+    existing_columns = set(c[1] for c in db.execute('PRAGMA {0}table_info({1})'.format(prefix, TABLE_META)))
+    for column in TABLE_META_COLUMNS:
+        if column not in existing_columns:
+            db.execute('ALTER TABLE {0}{1} ADD COLUMN {2}'.format(prefix, TABLE_META, column))
+
+
+def get_table_meta(db, schema_name, table_name):
+    """
+    Get the recorded metadata of schema_name.table_name.
+
+    :return: dict of metadata column to value or None if the table was never loaded
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    try:
+        cursor = db.execute('SELECT * FROM {0}{1} WHERE table_name = ?'.format(prefix, TABLE_META),
+                            (table_name,))
+    except sqlite3.OperationalError:
+        # no meta table (or no such schema) yet
+        return None
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip((d[0] for d in cursor.description), row))
+
+
+def set_table_meta(db, schema_name, table_name, **fields):
+    """
+    Update the recorded metadata of schema_name.table_name with given fields.
+    """
+    prefix = '{0}.'.format(schema_name) if schema_name else ''
+    db.execute('INSERT OR IGNORE INTO {0}{1} (table_name) VALUES (?)'.format(prefix, TABLE_META),
+               (table_name,))
+    if fields:
+        assignments = ', '.join('{0} = ?'.format(k) for k in fields)
+        db.execute('UPDATE {0}{1} SET {2} WHERE table_name = ?'.format(prefix, TABLE_META, assignments),
+                   list(fields.values()) + [table_name])
+
+
+def create_table_as(db, schema_name, table_name, query, index_columns=()):
+    """
+    Replace schema_name.table_name with a table of the result of given query, indexed on given columns if any.
+    """
+    drop_table(db, schema_name, table_name)
+    db.execute('CREATE TABLE {0}.{1} AS {2}'.format(schema_name, table_name, query))
+    if index_columns:
+        db.execute('CREATE INDEX {0}.{1}_index ON {1} ({2})'.format(schema_name, table_name, ', '.join(index_columns)))
+
+
+def set_materialized_view(db, schema_name, view_name, query, dependencies, index_columns=()):
+    """
+    Record the definition of the materialized view schema_name.view_name.
+
+    :param dependencies: list of the (region, table name) of the tables the view is computed from
+    """
+    db.execute('CREATE TABLE IF NOT EXISTS {0}.{1} (view_name PRIMARY KEY, query, dependencies, index_columns)'
+               .format(schema_name, MATERIALIZED_VIEWS))
+    db.execute('INSERT OR REPLACE INTO {0}.{1} VALUES (?, ?, ?, ?)'.format(schema_name, MATERIALIZED_VIEWS),
+               (view_name, query, json.dumps(dependencies), json.dumps(list(index_columns))))
+
+
+def get_materialized_view(db, schema_name, view_name):
+    """
+    Get the recorded definition of the materialized view schema_name.view_name.
+
+    :return: dict of the view query, dependencies and index columns or None if there is no such view
+    """
+    try:
+        row = db.execute('SELECT query, dependencies, index_columns FROM {0}.{1} WHERE view_name = ?'
+                         .format(schema_name, MATERIALIZED_VIEWS), (view_name,)).fetchone()
+    except sqlite3.OperationalError:
+        # no materialized views table (or no such schema) yet
+        return None
+    if row is None:
+        return None
+    return {
+        'query': row[0],
+        'dependencies': [tuple(d) for d in json.loads(row[1])],
+        'index_columns': json.loads(row[2]),
+    }
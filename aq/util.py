@@ -1,7 +1,13 @@
+import errno
 import os
+import subprocess
+import sys
 
 from aq.errors import AQError
 
+# quit if the output fits on one screen, keep colors, don't wrap long lines and don't clear the screen
+DEFAULT_PAGER = 'less -FRSX'
+
 
 def ensure_data_dir_exists():
     data_dir = os.path.expanduser('~/.aq')
@@ -14,3 +20,35 @@ def ensure_data_dir_exists():
                           ''.format(data_dir, e))
 
 
+def ensure_dir_exists(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            raise AQError('Cannot create dir at "{0}" because of: {1}.'.format(path, e))
+
+
+def page(chunks):
+    """
+    Write given chunks of text to the pager ($PAGER, or less), or to the standard output if it's not a terminal.
+    Chunks are written as they come and are not consumed anymore once the pager is quit.
+    """
+    if not sys.stdout.isatty():
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        return
+    pager = subprocess.Popen(os.environ.get('PAGER') or DEFAULT_PAGER, shell=True,
+                             stdin=subprocess.PIPE, universal_newlines=True)
+    try:
+        for chunk in chunks:
+            pager.stdin.write(chunk)
+    except IOError as e:
+        # the pager was quit before the end
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        try:
+            pager.stdin.close()
+        except IOError:
+            pass
+        pager.wait()
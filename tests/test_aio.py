@@ -0,0 +1,87 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipIf
+
+from aq.errors import QueryError
+
+if sys.version_info >= (3, 6):
+    # the module uses async syntax which older versions cannot even parse
+    import asyncio
+
+    from aq.aio import AsyncEngine
+
+
+@skipIf(sys.version_info < (3, 6), 'aq.aio needs Python 3.6 or later')
+class TestAsyncEngine(TestCase):
+    def setUp(self):
+        # tables are cached in a temporary data dir instead of the real ~/.aq
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(os.environ['HOME'])
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+
+    def test_query(self):
+        engine = AsyncEngine({})
+        try:
+            result = self.loop.run_until_complete(
+                engine.query('select 1 union all select 2 union all select 3', batch_size=2))
+            rows = self.loop.run_until_complete(result.fetchall())
+        finally:
+            engine.close()
+        self.assertEqual(result.columns, ['1'])
+        self.assertEqual(rows, [(1,), (2,), (3,)])
+
+    def test_concurrent_queries_share_table_load(self):
+        engine = AsyncEngine({'--region': 'us-east-1'})
+        item = type('Item', (object,), {'id': 'a'})
+        fetched = []
+
+        def fetch_table(resource, collection, limit=None, cancel_event=None):
+            fetched.append(threading.current_thread())
+            # long enough for the second query to find the table being loaded
+            time.sleep(0.1)
+            return ['id'], [item()], 0.1
+
+        try:
+            sync_engine = self.loop.run_until_complete(engine.get_engine())
+            sync_engine.get_table_collection = lambda region, table_name, predicates=(): (None, None)
+            sync_engine.get_fetch_filter = lambda region, table_name, meta: None
+            sync_engine.fetch_table = fetch_table
+            results = self.loop.run_until_complete(asyncio.gather(
+                engine.query('select id from test_aio_shared'),
+                engine.query('select count(*) from test_aio_shared')))
+            rows = [self.loop.run_until_complete(result.fetchall()) for result in results]
+        finally:
+            engine.close()
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(rows, [[('a',)], [(1,)]])
+
+    def test_query_timeout_while_fetching(self):
+        engine = AsyncEngine({'--query-timeout': '0.1'})
+        digits = '({0})'.format(' union all '.join('select {0} as x'.format(i) for i in range(10)))
+        # the first row comes right away but finding the next one takes too long
+        query = ('select 0 as x union all select a.x from {0} a, {0} b, {0} c, {0} d, {0} e, {0} f, {0} g, {0} h '
+                 'where min(a.x, b.x, c.x, d.x, e.x, f.x, g.x, h.x) = 9'.format(digits))
+        try:
+            result = self.loop.run_until_complete(engine.query(query))
+            with self.assertRaises(QueryError) as context:
+                self.loop.run_until_complete(result.fetchall())
+            self.assertIn('timed out', str(context.exception))
+            # the deadline is only for the query that timed out
+            result = self.loop.run_until_complete(engine.query('select 1'))
+            self.assertEqual(self.loop.run_until_complete(result.fetchall()), [(1,)])
+        finally:
+            engine.close()
@@ -1,14 +1,46 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
 from unittest import TestCase
 
 import boto3
 from botocore.exceptions import NoRegionError
 
-from aq import BotoSqliteEngine
-from aq.engines import get_resource_model_attributes
+from aq import BotoSqliteEngine, get_engine
+from aq import engines
+from aq.errors import QueryError
+from aq.engines import get_resource_model_attributes, estimate_fetch_seconds, get_change_ratio, parse_table_ttls, \
+    get_columns_list, merge_table_loads, PerTableBotoSqliteEngine, ParentScopedCollection, TableLoad
+from aq.sqlite_util import get_table_meta
+from aq.sqlite_util import jsonify
+from aq.parsers import SelectParser, QueryMetadata, Predicate, TableId
 
 
-class TestBotoEngine(TestCase):
-    engine = BotoSqliteEngine({})
+class DataDirTestCase(TestCase):
+    """
+    Test case whose engines cache their tables in a temporary data dir instead of the real ~/.aq,
+    so tests always start from an empty cache.
+    """
+
+    def setUp(self):
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(os.environ['HOME'])
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+
+
+class TestBotoEngine(DataDirTestCase):
+    def setUp(self):
+        super(TestBotoEngine, self).setUp()
+        self.engine = BotoSqliteEngine({})
 
     def test_is_attached_region(self):
         # main is always attached
@@ -33,3 +65,301 @@ class TestBotoEngine(TestCase):
             assert attributes
             assert 'instance_id' in attributes
             assert 'image_id' in attributes
+
+    def test_jsonify_resource_reference(self):
+        ec2 = boto3.resource('ec2', region_name='us-east-1')
+        self.assertEqual(jsonify({'instance': ec2.Instance('i-1234')}), '{"instance": "i-1234"}')
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        self.assertEqual(jsonify([s3.ObjectSummary('foo', 'bar')]), '[{"bucket_name": "foo", "key": "bar"}]')
+
+    def test_estimate_fetch_seconds(self):
+        self.assertIsNone(estimate_fetch_seconds(None))
+        meta = {'refreshed_at': 1, 'fetch_limit': None, 'row_count': 1000, 'fetch_seconds': 10.0}
+        self.assertEqual(estimate_fetch_seconds(meta), 10.0)
+        self.assertEqual(estimate_fetch_seconds(meta, limit=100), 1.0)
+        self.assertEqual(estimate_fetch_seconds(meta, limit=5000), 10.0)
+
+    def test_fetch_plan_over_budget(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--max-fetch-seconds': '5', '--table-cache-ttl': '0'})
+        schema_name = engine.attach_storage('us_east_1', 'test_fetch_budget')
+        self.assertEqual(engine.get_fetch_plan(schema_name, 'test_fetch_budget'), (engines.FETCH, None))
+
+        item = namedtuple('Item', ['id'])('a')
+        engine.store_table(schema_name, 'test_fetch_budget', ['id'], [item, item], fetch_seconds=10.0)
+        # cache is stale right away with a 0 ttl, but still better than waiting
+        self.assertEqual(engine.get_fetch_plan(schema_name, 'test_fetch_budget'), (engines.USE_STALE_CACHE, 10.0))
+        self.assertEqual(engine.get_fetch_plan(schema_name, 'test_fetch_budget', limit=1), (engines.FETCH, 5.0))
+
+        # the estimate still comes from the last full fetch but the partial table cannot be used for all rows
+        engine.store_table(schema_name, 'test_fetch_budget', ['id'], [item], limit=1)
+        self.assertEqual(engine.get_fetch_plan(schema_name, 'test_fetch_budget'), (engines.OVER_BUDGET, 10.0))
+
+    def test_table_ttls(self):
+        self.assertEqual(parse_table_ttls('ec2_instances=60, iam_*=86400'), [('ec2_instances', 60), ('iam_*', 86400)])
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--table-ttls': 'ec2_instances=60,iam_*=86400'})
+        self.assertEqual(engine.get_configured_ttl('ec2_instances'), 60)
+        self.assertEqual(engine.get_configured_ttl('iam_policies'), 86400)
+        self.assertEqual(engine.get_configured_ttl('ec2_images'), 300)
+
+    def test_adaptive_ttl(self):
+        self.assertEqual(get_change_ratio({'a', 'b'}, {'a', 'b'}), 0)
+        self.assertEqual(get_change_ratio({'a', 'b'}, {'a', 'c'}), 2.0 / 3)
+
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--adaptive-ttl': True})
+        schema_name = engine.attach_storage('us_east_1', 'test_adaptive_ttl')
+        item = namedtuple('Item', ['id'])
+        engine.store_table(schema_name, 'test_adaptive_ttl', ['id'], [item('a'), item('b')])
+        engine.store_table(schema_name, 'test_adaptive_ttl', ['id'], [item('a'), item('b')])
+        self.assertEqual(get_table_meta(engine.db, schema_name, 'test_adaptive_ttl')['ttl'], 600)
+        engine.store_table(schema_name, 'test_adaptive_ttl', ['id'], [item('a'), item('c')])
+        meta = get_table_meta(engine.db, schema_name, 'test_adaptive_ttl')
+        self.assertEqual((meta['ttl'], meta['change_ratio']), (300, 2.0 / 3))
+
+    def test_sample(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--sample': '100'})
+        self.assertTrue(engine.region_db_file_path('us_east_1').endswith('/.aq/sample/us_east_1.db'))
+        _, meta = SelectParser.parse_query('select count(*) from ec2_instances')
+        self.assertEqual(engine.get_fetch_limit(meta), 100)
+        _, meta = SelectParser.parse_query('select * from ec2_instances limit 10')
+        self.assertEqual(engine.get_fetch_limit(meta), 10)
+
+    def test_load_table_sample(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--sample': '5'})
+        fetched = []
+
+        def fetch_table(resource, collection, limit=None, cancel_event=None):
+            fetched.append(limit)
+            return ['id'], [], 0
+
+        engine.get_table_collection = lambda region, table_name, predicates=(): (None, None)
+        engine.fetch_table = fetch_table
+        engine.load_table(TableId(None, 'test_load_sample', None))
+        # the prefetched table is a sample too, not the whole table
+        self.assertEqual(fetched, [5])
+        self.assertEqual(get_table_meta(engine.db, 'us_east_1', 'test_load_sample')['fetch_limit'], 5)
+
+    def test_query_timeout(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--query-timeout': '0.1'})
+        query = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c'
+        with self.assertRaises(QueryError) as context:
+            engine.execute(query, QueryMetadata(tables=[]))
+        self.assertIn('timed out', str(context.exception))
+        # the deadline is only for the query that timed out
+        self.assertEqual(engine.execute('SELECT 1', QueryMetadata(tables=[]))[1], [(1,)])
+
+    def test_query_timeout_between_batches(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1', '--query-timeout': '0.1'})
+        cursor = engine.execute_cursor('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 100000) '
+                                       'SELECT x FROM c', QueryMetadata(tables=[]))
+        rows = engine.fetch_rows(cursor)
+        first_rows = [next(rows) for _ in range(1000)]
+        # e.g. the first rows being read in a pager
+        time.sleep(0.2)
+        self.assertEqual(first_rows + list(rows), [(x,) for x in range(1, 100001)])
+
+    def test_fetch_table_cancelled(self):
+        cancel_event = threading.Event()
+
+        class Collection(object):
+            def all(self):
+                return self
+
+            def pages(self):
+                yield [namedtuple('Item', ['id'])('a')]
+                cancel_event.set()
+                yield [namedtuple('Item', ['id'])('b')]
+
+        engines.get_columns_list, get_columns_list = lambda resource, collection: ['id'], engines.get_columns_list
+        try:
+            with self.assertRaises(QueryError):
+                BotoSqliteEngine.fetch_table(None, Collection(), cancel_event=cancel_event)
+        finally:
+            engines.get_columns_list = get_columns_list
+
+    def test_unknown_table_collection(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        with self.assertRaises(QueryError):
+            engine.get_table_collection('us_east_1', 'foobar')
+        with self.assertRaises(QueryError):
+            engine.get_table_collection('us_east_1', 'foo_bar')
+
+    def test_merge_table_loads(self):
+        self.assertEqual(merge_table_loads([TableLoad(10, None, ()), TableLoad(15, None, ())]), TableLoad(15, None, ()))
+        self.assertEqual(merge_table_loads([TableLoad(10, None, ()), TableLoad(None, None, ())]),
+                         TableLoad(None, None, ()))
+        foo = TableLoad(None, '{"bucket_name": ["foo"]}', (Predicate('bucket_name', '=', ('foo',)),))
+        bar = TableLoad(None, '{"bucket_name": ["bar"]}', (Predicate('bucket_name', '=', ('bar',)),))
+        self.assertEqual(merge_table_loads([foo, foo]), foo)
+        self.assertEqual(merge_table_loads([foo, TableLoad(None, None, ())]), TableLoad(None, None, ()))
+        self.assertIsNone(merge_table_loads([foo, bar]))
+        self.assertIsNone(merge_table_loads([foo, TableLoad(10, None, ())]))
+
+    def test_load_query_tables(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        fetched = []
+
+        def fetch_table(resource, collection, limit=None, cancel_event=None):
+            fetched.append((collection, limit))
+            return ['id'], [], 0
+
+        engine.get_table_collection = lambda region, table_name, predicates=(): (None, (table_name, predicates))
+        engine.get_fetch_filter = lambda region, table_name, meta: repr(meta.predicates) if meta.predicates else None
+        engine.fetch_table = fetch_table
+        queries = ['select * from test_load_a limit 10', 'select * from test_load_a limit 5 offset 10',
+                   'select * from test_load_b limit 1', 'select count(*) from test_load_b',
+                   "select * from test_load_c where id = 'a'", "select * from test_load_c where id = 'a'",
+                   "select * from test_load_d where id = 'a'", "select * from test_load_d where id = 'b'"]
+        engine.load_query_tables([SelectParser.parse_query(query)[1] for query in queries])
+        # each table is loaded once, with the most rows any query needs,
+        # tables needed with different filters are left for each query to load
+        self.assertEqual(sorted(fetched), [
+            (('test_load_a', ()), 15),
+            (('test_load_b', ()), None),
+            (('test_load_c', (Predicate('id', '=', ('a',)),)), None),
+        ])
+
+    def test_load_tables_waits_for_other_engines(self):
+        item = namedtuple('Item', ['id'])
+        loading = threading.Event()
+
+        def load():
+            # engines cannot be shared between threads
+            other_engine = BotoSqliteEngine({'--region': 'us-east-1'})
+            with other_engine.get_table_load_lock('us_east_1', 'test_load_wait'):
+                loading.set()
+                time.sleep(0.1)
+                other_engine.store_table('us_east_1', 'test_load_wait', ['id'], [item('a')])
+
+        thread = threading.Thread(target=load)
+        thread.start()
+        loading.wait()
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        query, meta = SelectParser.parse_query('select count(*) from test_load_wait')
+        # the table loaded by the other engine is used instead of being fetched again
+        self.assertEqual(engine.execute(query, meta)[1], [(1,)])
+        thread.join()
+
+    def test_materialized_view(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        item = namedtuple('Item', ['id', 'size'])
+        engine.store_table('us_east_1', 'test_view_source', ['id', 'size'], [item('a', 1), item('b', 2)])
+        query, meta = SelectParser.parse_query('create materialized view test_view index on (id) as '
+                                               'select id, size * 2 as double_size from test_view_source')
+        self.assertEqual(engine.execute(query, meta)[1], [('us_east_1.test_view', 2)])
+        query, meta = SelectParser.parse_query("select double_size from us_east_1.test_view where id = 'b'")
+        self.assertEqual(engine.execute(query, meta)[1], [(4,)])
+
+        # the view is recomputed once its table is refreshed
+        engine.store_table('us_east_1', 'test_view_source', ['id', 'size'], [item('b', 3)])
+        self.assertEqual(engine.execute(query, meta)[1], [(6,)])
+        view = engine.split_materialized_views(meta)[0][0][2]
+        self.assertEqual(view['dependencies'], [('us_east_1', 'test_view_source')])
+
+    def test_materialized_view_reserved_names(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        engine.store_table('us_east_1', 'test_view_source', ['id'], [namedtuple('Item', ['id'])('a')])
+        for name in ('aq_tables', 'test_view_history', 'test_view_data', 'ec2_instances', 's3_bucket_objects'):
+            with self.assertRaises(QueryError):
+                engine.execute(*SelectParser.parse_query('create materialized view {0} as select 1'.format(name)))
+        self.assertIsNotNone(get_table_meta(engine.db, 'us_east_1', 'test_view_source'))
+
+    def test_materialized_view_cycle(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        engine.store_table('us_east_1', 'test_view_source', ['id'], [namedtuple('Item', ['id'])('a')])
+        engine.execute(*SelectParser.parse_query('create materialized view test_view_b as '
+                                                 'select id from test_view_source'))
+        engine.execute(*SelectParser.parse_query('create materialized view test_view_a as select id from test_view_b'))
+        with self.assertRaises(QueryError):
+            engine.execute(*SelectParser.parse_query('create materialized view test_view_b as '
+                                                     'select id from test_view_a'))
+        self.assertEqual(engine.execute(*SelectParser.parse_query('select * from test_view_a'))[1], [('a',)])
+
+    def test_parent_scoped_collection(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        resource, collection = engine.get_table_collection('us_east_1', 's3_bucket_objects', (
+            Predicate('bucket_name', 'IN', ('foo', 'bar')),
+            Predicate('key', 'LIKE', ('logs/%',)),
+            Predicate('key', 'GLOB', ('logs/2017-*',)),
+        ))
+        self.assertIsInstance(collection, ParentScopedCollection)
+        self.assertEqual(get_columns_list(resource, collection)[:2], ['bucket_name', 'key'])
+        self.assertEqual([b.name for b in collection.get_parents()], ['bar', 'foo'])
+        # LIKE is case-insensitive so only the GLOB prefix can be pushed down
+        self.assertEqual(collection.filters, {'Prefix': 'logs/2017-'})
+
+        _, meta = SelectParser.parse_query("select * from s3_bucket_objects where bucket_name = 'foo'")
+        self.assertEqual(engine.get_fetch_filter('us_east_1', 's3_bucket_objects', meta), '{"bucket_name": ["foo"]}')
+
+        _, collection = engine.get_table_collection('us_east_1', 'iam_policy_versions')
+        self.assertEqual(collection.parent_columns, ['policy_arn'])
+
+    def test_fetch_filter_of_top_level_collection(self):
+        engine = BotoSqliteEngine({'--region': 'us-east-1'})
+        _, meta = SelectParser.parse_query("select * from ec2_instances where id = 'a'")
+        self.assertIsNone(engine.get_fetch_filter('us_east_1', 'ec2_instances', meta))
+        # the table is known not to be filterable without building its resource again
+        engine.boto3_session = None
+        self.assertIsNone(engine.get_fetch_filter('us_east_1', 'ec2_instances', meta))
+
+
+class TestPerTableBotoEngine(DataDirTestCase):
+    def setUp(self):
+        super(TestPerTableBotoEngine, self).setUp()
+        self.engine = PerTableBotoSqliteEngine({'--region': 'us-east-1'})
+
+    def test_rewrite_query(self):
+        query, meta = SelectParser.parse_query(
+            "select ec2_instances.id, v.size from ec2_instances "
+            "join us_west_1.ec2_volumes v on v.id = 'ec2_instances'")
+        self.assertEqual(self.engine.rewrite_query(query, meta),
+                         "SELECT ec2_instances.id , v.size FROM us_east_1__ec2_instances . ec2_instances "
+                         "JOIN us_west_1__ec2_volumes . ec2_volumes v ON v.id = 'ec2_instances'")
+
+    def test_rewrite_query_column_with_region(self):
+        query, meta = SelectParser.parse_query('select us_west_1.ec2_volumes.id from us_west_1.ec2_volumes')
+        self.assertEqual(self.engine.rewrite_query(query, meta),
+                         'SELECT us_west_1__ec2_volumes.ec2_volumes.id FROM us_west_1__ec2_volumes . ec2_volumes')
+
+    def test_attach_query_tables(self):
+        engine = PerTableBotoSqliteEngine({'--region': 'us-east-1'})
+        engine.max_attached_databases = 3
+        item = namedtuple('Item', ['id'])
+        for table_name in ('test_attach_a', 'test_attach_b', 'test_attach_c'):
+            engine.store_table(engine.attach_storage('us_east_1', table_name), table_name, ['id'], [item('a')])
+        query, meta = SelectParser.parse_query('select count(*) from test_attach_a, test_attach_b')
+        self.assertEqual(engine.execute(query, meta)[1], [(1,)])
+        # tables of the same query are never detached to attach the others
+        query, meta = SelectParser.parse_query('select count(*) from test_attach_a, test_attach_b, test_attach_c')
+        with self.assertRaises(QueryError) as context:
+            engine.execute(query, meta)
+        self.assertIn('more than the 2 tables', str(context.exception))
+
+    def test_materialized_view(self):
+        item = namedtuple('Item', ['id'])
+        self.engine.store_table(self.engine.attach_storage('us_east_1', 'test_view_source'),
+                                'test_view_source', ['id'], [item('a'), item('b')])
+        query, meta = SelectParser.parse_query('create materialized view us_east_1.test_view as '
+                                               'select count(*) as total from test_view_source')
+        self.engine.execute(query, meta)
+        query, meta = SelectParser.parse_query('select total from test_view')
+        self.assertEqual(self.engine.execute(query, meta)[1], [(2,)])
+        self.assertEqual(self.engine.get_table_catalog(meta.tables[0])[0], ['total'])
+
+    def test_table_catalog_of_unknown_table(self):
+        table = TableId(None, 'test_catalog_unknown', None)
+        with self.assertRaises(QueryError):
+            self.engine.get_table_catalog(table)
+        self.assertFalse(self.engine.has_storage('us_east_1', 'test_catalog_unknown'))
+
+
+class TestInMemoryBotoEngine(DataDirTestCase):
+    def test_execute(self):
+        engine = get_engine({'--region': 'us-east-1', '--storage': 'memory'})
+        item = namedtuple('Item', ['id'])
+        engine.store_table('us_east_1', 'test_memory', ['id'], [item('a'), item('b')])
+        query, meta = SelectParser.parse_query('select count(*) from test_memory')
+        self.assertEqual(engine.execute(query, meta)[1], [(2,)])
+        # other engines of the process share the same tables
+        other_engine = get_engine({'--region': 'us-east-1', '--storage': 'memory'})
+        query, meta = SelectParser.parse_query('select count(*) from us_east_1.test_memory')
+        self.assertEqual(other_engine.execute(query, meta)[1], [(2,)])
@@ -0,0 +1,33 @@
+import array
+from unittest import TestCase
+
+from aq.columnar import fetch_columns
+from aq.sqlite_util import connect
+
+
+class TestColumnar(TestCase):
+    def fetch(self, values):
+        with connect(':memory:') as conn:
+            conn.execute('CREATE TABLE foo (foo)')
+            conn.executemany('INSERT INTO foo (foo) VALUES (?)', [(v,) for v in values])
+            _, data = fetch_columns(conn.execute('SELECT foo FROM foo'), batch_size=2, use_numpy=False)
+            return data[0]
+
+    def test_integer_column(self):
+        column = self.fetch([1, 2, 3])
+        self.assertEqual(column, array.array('q', [1, 2, 3]))
+
+    def test_float_column(self):
+        column = self.fetch([1, 2, 3.5])
+        self.assertEqual(column, array.array('d', [1, 2, 3.5]))
+
+    def test_non_numeric_column(self):
+        column = self.fetch([1, 2, None, 'foo'])
+        self.assertEqual(column, [1, 2, None, 'foo'])
+
+    def test_columns(self):
+        with connect(':memory:') as conn:
+            columns, data = fetch_columns(conn.execute("SELECT 1 a, 'x' a"))
+            self.assertEqual(columns, ['a', 'a'])
+            self.assertEqual(len(data), 2)
+            self.assertEqual(data[1], ['x'])
@@ -0,0 +1,28 @@
+from unittest import TestCase
+
+from aq.formatters import TableFormatter
+
+
+class TestTableFormatter(TestCase):
+    formatter = TableFormatter({})
+
+    def test_format_chunks(self):
+        chunks = list(self.formatter.format_chunks(['id', 'name'], [(1, 'foo'), (22, None)],
+                                                   iter([(3, 'blah'), (4, 'longer than foo')]), chunk_size=3))
+        # header, 2 chunks of rows and the bottom border
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(''.join(chunks), '\n'.join([
+            '+----+------+',
+            '| id | name |',
+            '|----+------|',
+            '|  1 | foo  |',
+            '| 22 | NULL |',
+            '|  3 | blah |',
+            '|  4 | longer than foo |',
+            '+----+------+',
+        ]) + '\n')
+
+    def test_format_chunks_sample(self):
+        formatter = TableFormatter({'--sample': '10'})
+        output = ''.join(formatter.format_chunks(['id'], [(1,)], iter([])))
+        self.assertTrue(output.endswith('sample of the first 10 rows of each table\n'))
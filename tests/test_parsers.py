@@ -1,7 +1,7 @@
 from unittest import TestCase
 
 from aq.errors import QueryParsingError
-from aq.parsers import SelectParser, TableId
+from aq.parsers import SelectParser, TableId, QueryMetadata, Predicate, MaterializedView, split_statements
 
 
 class TestSelectParser(TestCase):
@@ -97,3 +97,58 @@ class TestSelectParser(TestCase):
     def test_parse_query_with_or(self):
         query, _ = self.parser.parse_query("select * from foo where x = 'foo' or y = 'bar'")
         self.assertEqual(query, "SELECT * FROM foo WHERE x = 'foo' OR y = 'bar'")
+
+    def test_parse_query_keeps_parentheses(self):
+        query, _ = self.parser.parse_query("select * from foo where (x = 'foo' or y = 'bar') and z = 'blah'")
+        self.assertEqual(query, "SELECT * FROM foo WHERE ( x = 'foo' OR y = 'bar' ) AND z = 'blah'")
+
+    def test_parse_query_predicates(self):
+        _, meta = self.parser.parse_query(
+            "select * from foo f where f.x in ('a', 'b') and (y like 'c%' and z > 1) and (w = 'd' or w = 'e')")
+        self.assertEqual(meta.predicates, (Predicate('x', 'IN', ('a', 'b')), Predicate('y', 'LIKE', ('c%',))))
+
+    def test_parse_query_no_predicates(self):
+        for query in ("select * from foo where x = 'a' or y = 'b'",
+                      "select * from foo join bar where x = 'a'",
+                      "select * from (select * from foo where x = 'a')",
+                      "select * from foo where bar.x = 'a'",
+                      "select * from foo where x = 1"):
+            _, meta = self.parser.parse_query(query)
+            self.assertEqual(meta.predicates, (), query)
+
+    def test_parse_query_limit(self):
+        _, meta = self.parser.parse_query('select * from foo limit 5')
+        self.assertEqual(meta.limit, 5)
+
+        _, meta = self.parser.parse_query('select id from foo limit 5 offset 10')
+        self.assertEqual(meta.limit, 15)
+
+        _, meta = self.parser.parse_query('select id from foo limit 10, 5')
+        self.assertEqual(meta.limit, 15)
+
+    def test_parse_query_limit_needs_all_rows(self):
+        for query in ('select * from foo',
+                      'select * from foo order by id limit 5',
+                      "select * from foo where id = 'x' limit 5",
+                      'select count(*) from foo limit 5',
+                      'select distinct id from foo limit 5',
+                      'select * from foo join bar limit 5',
+                      'select * from (select * from foo) limit 5',
+                      'select * from foo limit -1'):
+            _, meta = self.parser.parse_query(query)
+            self.assertEqual(meta.limit, None, query)
+
+    def test_parse_query_create_materialized_view(self):
+        query, meta = self.parser.parse_query(
+            "create materialized view us_west_1.foo_bar index on (id, x) as "
+            "select * from foo join bar using (id) where x = 'a' limit 5")
+        self.assertEqual(query, "SELECT * FROM foo JOIN bar USING ( id ) WHERE x = 'a' LIMIT 5")
+        # the view is computed from all rows of its tables
+        self.assertEqual(meta, QueryMetadata(tables=[TableId(None, 'foo', None), TableId(None, 'bar', None)],
+                                             materialized_view=MaterializedView('us_west_1', 'foo_bar', ('id', 'x'))))
+
+
+class TestBatchQueries(TestCase):
+    def test_split_statements(self):
+        text = "select 1; -- comment; here\nselect 'a;b', x->'y' ;; select 2"
+        self.assertEqual(split_statements(text), ['select 1', "select 'a;b', x->'y'", 'select 2'])
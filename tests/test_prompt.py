@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from prompt_toolkit.document import Document
+
+from aq.parsers import SelectParser, TableId
+from aq.prompt import AqCompleter, PrefixIndex, TablePrefetcher
+
+
+class TestAqCompleter(TestCase):
+    def complete(self, completer, text):
+        return [c.text for c in completer.get_completions(Document(text), None)]
+
+    def test_prefix_index(self):
+        index = PrefixIndex(['ec2_instances', 'EC2_images', 'iam_users'])
+        self.assertEqual(list(index.starting_with('ec2_i')), ['EC2_images', 'ec2_instances'])
+        self.assertEqual(list(index.starting_with('s3')), [])
+
+    def test_complete_tables(self):
+        completer = AqCompleter(schemas=['us_east_1'], tables=iter(['ec2_instances', 'ec2_volumes']))
+        self.assertEqual(self.complete(completer, 'select * from ec2_v'), ['ec2_volumes'])
+        # tables are still there on the next completion
+        self.assertEqual(self.complete(completer, 'select * from ec2_i'), ['ec2_instances'])
+
+    def test_complete_columns_and_json_keys(self):
+        completer = AqCompleter(tables=['ec2_instances'])
+        completer.update_catalog(['instance_id', 'tags'], {'tags': {'Name', 'Team'}})
+        self.assertEqual(self.complete(completer, 'select inst'), ['instance_id'])
+        self.assertEqual(self.complete(completer, "select tags->'N"), ["'Name'"])
+        self.assertEqual(self.complete(completer, 'select tags -> '), ["'Name'", "'Team'"])
+
+
+class TestTablePrefetcher(TestCase):
+    def test_predict_from_recorded_queries(self):
+        prefetcher = TablePrefetcher(SelectParser({}), engine=None, max_tables=2)
+        instances = TableId(None, 'ec2_instances', None)
+        volumes = TableId(None, 'ec2_volumes', None)
+        groups = TableId(None, 'ec2_security_groups', None)
+
+        for _ in range(2):
+            prefetcher.record([instances._replace(alias='i')])
+            prefetcher.record([volumes])
+            prefetcher.record([groups])
+
+        self.assertEqual(prefetcher.predict([instances]), [volumes])
+        self.assertEqual(prefetcher.predict([volumes]), [groups])
+        # each record queues the tables predicted to be queried next
+        self.assertEqual(prefetcher.queue.get_nowait(), [])
+        self.assertEqual(prefetcher.queue.qsize(), 5)
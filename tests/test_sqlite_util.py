@@ -1,6 +1,11 @@
+import sqlite3
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 
-from aq.sqlite_util import connect, create_table, insert_all
+from aq.sqlite_util import connect, create_table, insert_all, create_snapshot_tables, insert_snapshot, \
+    connect_readonly, ensure_table_meta, get_table_meta, set_table_meta, jsonify, register_serializer, \
+    create_interned_table, transaction
 
 
 class TestSqliteUtil(TestCase):
@@ -12,6 +17,14 @@ class TestSqliteUtil(TestCase):
             self.assertEqual(len(values), 1)
             self.assertEqual(values[0], '{"bar": "blah"}')
 
+    def test_jsonify(self):
+        class Foo(object):
+            pass
+
+        register_serializer(Foo, lambda foo: 'foo')
+        value = {'time': datetime(2016, 1, 2, 3, 4, 5), 'foo': [Foo()]}
+        self.assertEqual(jsonify(value), '{"time": "2016-01-02T03:04:05", "foo": ["foo"]}')
+
     def test_create_table(self):
         with connect(':memory:') as conn:
             create_table(conn, None, 'foo', ('col1', 'col2'))
@@ -65,3 +78,90 @@ class TestSqliteUtil(TestCase):
             json_obj = 'null'
             query = "select json_get('{0}', 'foo')".format(json_obj)
             self.assertEqual(conn.execute(query).fetchone()[0], None)
+
+    def test_insert_snapshot(self):
+        class Foo(object):
+            def __init__(self, c1, c2):
+                self.c1 = c1
+                self.c2 = c2
+
+        columns = ('c1', 'c2')
+        with connect(':memory:') as conn:
+            create_snapshot_tables(conn, None, 'foo', columns)
+            first = insert_snapshot(conn, None, 'foo', columns, (Foo(1, 2), Foo(3, 4)))
+            second = insert_snapshot(conn, None, 'foo', columns, (Foo(1, 2), Foo(3, 5)))
+            self.assertNotEqual(first, second)
+
+            # unchanged row (1, 2) is only stored once
+            versions = conn.execute('SELECT c1, c2 FROM foo_versions').fetchall()
+            self.assertEqual(len(versions), 3)
+
+            rows = conn.execute('SELECT c1, c2 FROM foo_history WHERE aq_snapshot_id = ?', (second,)).fetchall()
+            self.assertEqual(sorted(rows), [(1, 2), (3, 5)])
+
+    def test_snapshot_history_keeps_resource_columns(self):
+        class Snapshot(object):
+            def __init__(self, snapshot_id):
+                self.snapshot_id = snapshot_id
+
+        columns = ('snapshot_id',)
+        with connect(':memory:') as conn:
+            create_snapshot_tables(conn, None, 'foo', columns)
+            snapshot_id = insert_snapshot(conn, None, 'foo', columns, (Snapshot('snap-1'),))
+
+            # the history's own columns don't hide the resource attribute of the same name
+            rows = conn.execute("SELECT aq_snapshot_id, aq_taken_at FROM foo_history "
+                                "WHERE snapshot_id = 'snap-1'").fetchall()
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0][0], snapshot_id)
+            self.assertIsInstance(rows[0][1], float)
+
+    def test_table_meta(self):
+        with connect(':memory:') as conn:
+            self.assertEqual(get_table_meta(conn, None, 'foo'), None)
+            ensure_table_meta(conn, None)
+            set_table_meta(conn, None, 'foo', refreshed_at=1.5)
+            meta = get_table_meta(conn, None, 'foo')
+            self.assertEqual(meta['table_name'], 'foo')
+            self.assertEqual(meta['refreshed_at'], 1.5)
+
+    def test_connect_readonly(self):
+        db_file = tempfile.NamedTemporaryFile(suffix='.db')
+        with connect(db_file.name) as conn:
+            conn.execute('CREATE TABLE foo (foo)')
+            conn.execute('INSERT INTO foo (foo) VALUES (1)')
+        conn = connect_readonly(db_file.name, mmap_size=1024 * 1024)
+        self.assertEqual(conn.execute('SELECT foo FROM foo').fetchall(), [(1,)])
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute('INSERT INTO foo (foo) VALUES (2)')
+
+    def test_create_interned_table(self):
+        class Foo(object):
+            def __init__(self, c1, c2):
+                self.c1 = c1
+                self.c2 = c2
+
+        columns = ('c1', 'c2')
+        values = (Foo(1, {'foo': 'bar'}), Foo(2, {'foo': 'bar'}), Foo(3, None), Foo(4, {'foo': 'blah'}))
+        with connect(':memory:') as conn:
+            create_interned_table(conn, None, 'foo', columns, values)
+            rows = conn.execute("SELECT c1, c2 FROM foo WHERE json_get(c2, 'foo') = 'bar'").fetchall()
+            self.assertEqual(rows, [(1, '{"foo": "bar"}'), (2, '{"foo": "bar"}')])
+            self.assertEqual(conn.execute('SELECT count(*) FROM foo_values').fetchone()[0], 2)
+            self.assertEqual(conn.execute('SELECT c2 FROM foo WHERE c1 = 3').fetchone()[0], None)
+
+            # replaced by a plain table
+            create_table(conn, None, 'foo', columns)
+            self.assertEqual(conn.execute('SELECT count(*) FROM foo').fetchone()[0], 0)
+
+    def test_transaction_rollback(self):
+        with connect(':memory:') as conn:
+            create_table(conn, None, 'foo', ('c1',))
+            conn.execute('INSERT INTO foo (c1) VALUES (1)')
+            conn.commit()
+            with self.assertRaises(KeyboardInterrupt):
+                with transaction(conn):
+                    create_table(conn, None, 'foo', ('c2',))
+                    raise KeyboardInterrupt()
+            # the table was not dropped
+            self.assertEqual(conn.execute('SELECT c1 FROM foo').fetchall(), [(1,)])